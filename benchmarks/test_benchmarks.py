@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Benchmarks of bob.db.casiasurf on synthetic trees
+
+These benchmarks use pytest-benchmark (see ``benchmarks/requirements.txt``),
+and do not need the real database::
+
+  $ pip install -r benchmarks/requirements.txt
+  $ pytest benchmarks --benchmark-only
+
+To detect regressions, a run is saved as the baseline and later runs are
+compared to it, as in the continuous integration (``.gitlab-ci.yml``)::
+
+  $ pytest benchmarks --benchmark-only --benchmark-autosave
+  $ pytest benchmarks --benchmark-only --benchmark-compare --benchmark-compare-fail=min:50%
+
+By default, they run on the 'small' and 'medium' scales. Other scales can be
+selected with the CASIASURF_BENCHMARK_SCALES environment variable, e.g.
+``CASIASURF_BENCHMARK_SCALES=small,medium,large``.
+"""
+
+import os
+import shutil
+import argparse
+import tempfile
+
+import pytest
+
+import bob.db.casiasurf
+from bob.db.casiasurf import driver
+from bob.db.casiasurf.synthetic import generate, create_database
+
+# (number of training subjects, frames per training video, validation samples, test samples)
+SCALES = {
+  'small': (2, 5, 50, 50),
+  'medium': (10, 10, 500, 500),
+  'large': (40, 20, 5000, 5000),
+}
+
+SELECTED_SCALES = os.environ.get('CASIASURF_BENCHMARK_SCALES', 'small,medium').split(',')
+
+
+@pytest.fixture(scope='module', params=SELECTED_SCALES)
+def tree(request):
+  """Generates the synthetic tree of a scale"""
+  n_subjects, n_frames, n_validation, n_test = SCALES[request.param]
+  directory = tempfile.mkdtemp()
+  imagesdir, validlabel, testlabel = generate(directory, n_subjects=n_subjects, n_frames=n_frames,
+      n_validation=n_validation, n_test=n_test)
+  yield directory, imagesdir, validlabel, testlabel
+  shutil.rmtree(directory)
+
+
+@pytest.fixture(scope='module')
+def database(tree):
+  """Creates the database of a synthetic tree"""
+  directory, imagesdir, validlabel, testlabel = tree
+  dbfile = os.path.join(directory, 'db.sql3')
+  create_database(dbfile, imagesdir, validlabel, testlabel)
+  return dbfile, imagesdir
+
+
+@pytest.fixture
+def db(database, monkeypatch):
+  dbfile, imagesdir = database
+  # the driver commands open the default database
+  monkeypatch.setattr(bob.db.casiasurf.query, 'SQLITE_FILE', dbfile)
+  return bob.db.casiasurf.Database(original_directory=imagesdir, original_extension='.jpg', sqlite_file=dbfile)
+
+
+def test_create(benchmark, tree):
+  directory, imagesdir, validlabel, testlabel = tree
+  dbfile = os.path.join(directory, 'create.sql3')
+  benchmark.pedantic(create_database, args=(dbfile, imagesdir, validlabel, testlabel), rounds=3)
+
+
+def test_objects(benchmark, db):
+  benchmark(db.objects, groups=('test',))
+
+
+def test_count_objects(benchmark, db):
+  benchmark(db.count_objects, groups=('test',))
+
+
+def test_iter_objects(benchmark, db):
+  benchmark(lambda: sum(1 for _ in db.iter_objects(groups=('test',))))
+
+
+def test_dumplist(benchmark, db):
+  args = argparse.Namespace(protocol=None, purpose=None, group=None, shard_index=0, num_shards=1,
+      directory='', extension='', selftest=True)
+  benchmark(driver.dumplist, args)
+
+
+def test_checkfiles(benchmark, db):
+  args = argparse.Namespace(directory=db.original_directory, extension='.jpg', selftest=True)
+  benchmark(driver.checkfiles, args)
+
+
+def test_sample_load(benchmark, db):
+  samples = db.objects(groups=('validation',))[:50]
+  benchmark(lambda: [s.load(db.original_directory, '.jpg', 'all') for s in samples])
+
+
+def test_load_batches(benchmark, db):
+  batches = [[s.id for s in db.objects(groups=('validation',))[:64]]]
+  benchmark(lambda: list(db.load_batches(batches, stack=True)))
+
+
+def test_load_batches_sampler(benchmark, db):
+  sampler = bob.db.casiasurf.BatchSampler(db, 32, groups='train', num_batches=4, seed=0)
+  benchmark(lambda: list(db.load_batches(sampler, size=(16, 16))))
+
+
+def test_load_stream(benchmark, db):
+  benchmark(lambda: sum(1 for _ in db.load_stream(db.iter_objects(groups=('test',)), locality='path')))
@@ -2,6 +2,7 @@
 # encoding: utf-8
 
 from .query import Database
+from .sampler import BatchSampler
 import bob.io.image
 
 def get_config():
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""End-to-end throughput of the sample loading path
+
+A fixed number of samples is loaded by several worker processes (as a data
+loader would), through :py:meth:`bob.db.casiasurf.Database.load_stream`,
+and the throughput, the per-sample latencies and the time spent in each
+stage (see :py:mod:`bob.db.casiasurf.metrics`) are reported.
+"""
+
+import time
+import itertools
+
+import numpy
+
+import bob.core
+logger = bob.core.log.setup('bob.db.casiasurf')
+
+
+def _worker(task):
+  """Loads a list of samples, recording the latency of each one"""
+  from .metrics import registry
+  from .models import _rebuild_sample, modality_list
+  from .pool import EncodedPool
+  database, payloads, options, pool, window, locality = task
+  # a forked worker inherits the metrics of the parent
+  registry.reset()
+  registry.enabled = True
+  samples = [_rebuild_sample(*p) for p in payloads]
+
+  pool_time = None
+  if pool:
+    # the pool is not pickled with the database: each worker reads its own samples
+    start = time.perf_counter()
+    mods = modality_list(options['modality'])
+    database.pool = EncodedPool.read([(f.id, f.make_path(options['directory'], options['extension']), f.file_size)
+        for s in samples for f in s.files if f.modality in mods])
+    pool_time = time.perf_counter() - start
+
+  latencies = []
+  def record(kind, name, value):
+    if name == 'load.sample':
+      latencies.append(value)
+  registry.hooks.append(record)
+  try:
+    start = time.time()
+    for _ in database.load_stream(samples, window, locality=locality, **options):
+      pass
+    end = time.time()
+  finally:
+    registry.hooks.remove(record)
+  return start, end, latencies, registry.snapshot(), pool_time
+
+
+def run(database, protocol=None, groups=None, purposes=None, modality='all', num_samples=1000, workers=1,
+        directory=None, extension=None, size=None, gray=False, pool=False, window=256, locality=None):
+  """Loads samples with several worker processes, and reports the throughput
+
+  Parameters
+  ----------
+  database: :py:class:`bob.db.casiasurf.Database`
+    The database
+  protocol, groups, purposes:
+    The selection of the samples, see :py:meth:`bob.db.casiasurf.Database.objects`
+  modality: str or list of str
+    The modality(ies) to load
+  num_samples: int
+    The number of samples to load (the first ones of the selection)
+  workers: int
+    The number of worker processes
+  directory: str
+    The directory of the database. By default, the original directory.
+  extension: str
+    The extension of the image files. By default, the original extension.
+  size: tuple
+    If given, the (height, width) the images are resized to
+  gray: bool or list of str
+    The modalities loaded as grayscale, see :py:meth:`bob.db.casiasurf.models.Sample.load`
+  pool: bool
+    If set, each worker first reads the image files of its samples into
+    memory (see :py:meth:`bob.db.casiasurf.Database.load_pool`), and the
+    images are then decoded from memory
+  window, locality:
+    How the samples are read, see :py:meth:`bob.db.casiasurf.Database.load_stream`
+
+  Returns
+  -------
+  dict:
+    The number of samples and of workers, the wall-clock time, the number of
+    ``samples_per_second`` and ``mb_per_second`` (of encoded images, read
+    from disk or from the pool), the ``p50`` and ``p99`` per-sample
+    latencies (in seconds), the time spent querying the samples and
+    (if ``pool`` is set) reading the pools, and the total time spent in
+    each stage of the loading (``stages``)
+  """
+  import multiprocessing
+
+  start = time.perf_counter()
+  samples = list(itertools.islice(database.iter_objects(purposes=purposes, groups=groups, protocol=protocol), num_samples))
+  query_time = time.perf_counter() - start
+  if len(samples) < num_samples:
+    logger.warn("Only {} samples are selected, instead of {}".format(len(samples), num_samples))
+  if not samples:
+    raise ValueError("No sample is selected")
+
+  options = dict(
+    directory=directory or database.original_directory,
+    extension=extension or database.original_extension or '.jpg',
+    modality=modality,
+    size=size,
+    gray=gray,
+  )
+  workers = max(1, min(workers, len(samples)))
+  # contiguous slices, so that the order of the samples on disk is kept
+  bounds = numpy.linspace(0, len(samples), workers + 1).astype(int)
+  tasks = [(database, [s._payload() for s in samples[bounds[k]:bounds[k + 1]]], options, pool, window, locality)
+      for k in range(workers)]
+
+  processes = multiprocessing.Pool(workers)
+  try:
+    results = processes.map(_worker, tasks, chunksize=1)
+  finally:
+    processes.close()
+    processes.join()
+
+  # the startup of the workers is not accounted for
+  wall = max(r[1] for r in results) - min(r[0] for r in results)
+  latencies = numpy.concatenate([r[2] for r in results])
+  n_bytes = sum(r[3]['counters'].get('load.bytes_read', 0) + r[3]['counters'].get('load.pool_bytes', 0) for r in results)
+  stages = {}
+  for r in results:
+    for name, latency in r[3]['latencies'].items():
+      if name.startswith('load.') and name != 'load.sample':
+        stages[name[len('load.'):]] = stages.get(name[len('load.'):], 0.) + latency['sum']
+
+  return dict(
+    samples=len(latencies),
+    workers=workers,
+    wall=wall,
+    samples_per_second=len(latencies) / wall if wall else None,
+    mb_per_second=n_bytes / 1e6 / wall if wall else None,
+    bytes=n_bytes,
+    p50=float(numpy.percentile(latencies, 50)),
+    p99=float(numpy.percentile(latencies, 99)),
+    query=query_time,
+    pool=max(r[4] for r in results) if pool else None,
+    stages=stages,
+  )
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Memoisation of query results
+
+Results are stored as the compact payload of the samples (ids, groups,
+attack types and file paths), with an in-process tier shared by all
+:py:class:`bob.db.casiasurf.Database` instances and an optional on-disk
+tier, shared by all processes.
+
+Cache keys contain a fingerprint of the SQLite file (size, modification time
+and schema version), so that results are invalidated as soon as the database
+is re-created. The fingerprint is checked (with a single ``stat``) on each
+lookup. On-disk tiers in non-default directories are registered next to the
+SQLite file, so that they are all cleared when the database is re-created.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+import bob.core
+logger = bob.core.log.setup('bob.db.casiasurf')
+
+# in-process tier, shared by all databases
+_memory = {}
+
+
+def default_directory(dbfile):
+  """Returns the default directory of the on-disk tier, next to the SQLite file"""
+  return dbfile + '.cache'
+
+
+def fingerprint(dbfile, schema_version):
+  """Computes the fingerprint of an SQLite file
+
+  Parameters
+  ----------
+  dbfile: str
+    The path to the SQLite file
+  schema_version: int
+    The schema version stored in the SQLite file
+
+  Returns
+  -------
+  list:
+    The size, modification time (in ns) and schema version of the file
+  """
+  stat = os.stat(dbfile)
+  return [stat.st_size, stat.st_mtime_ns, schema_version]
+
+
+def _registry(dbfile):
+  """Returns the file listing the on-disk tiers of an SQLite file"""
+  return dbfile + '.cache-directories'
+
+
+def register(dbfile, directory):
+  """Records the directory of an on-disk tier of an SQLite file, see :py:func:`clear_all`"""
+  directory = os.path.abspath(directory)
+  if directory == os.path.abspath(default_directory(dbfile)):
+    return
+  registry = _registry(dbfile)
+  try:
+    if os.path.exists(registry):
+      with open(registry) as f:
+        if directory in f.read().splitlines():
+          return
+    with open(registry, 'a') as f:
+      f.write(directory + '\n')
+  except (IOError, OSError) as e:
+    logger.warn("Cannot register the query cache {}: {}".format(directory, e))
+
+
+def clear(directory=None):
+  """Clears the in-process tier and, if given, an on-disk tier
+
+  Parameters
+  ----------
+  directory: str
+    The directory of the on-disk tier to remove
+  """
+  _memory.clear()
+  if directory is not None and os.path.isdir(directory):
+    logger.info("Removing query cache {}".format(directory))
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def clear_all(dbfile):
+  """Clears the in-process tier and all the on-disk tiers of an SQLite file
+
+  Parameters
+  ----------
+  dbfile: str
+    The path to the SQLite file
+  """
+  clear(default_directory(dbfile))
+  registry = _registry(dbfile)
+  if os.path.exists(registry):
+    with open(registry) as f:
+      for directory in f.read().splitlines():
+        clear(directory)
+    os.unlink(registry)
+
+
+class QueryCache(object):
+  """A cache of query results for a given SQLite file
+
+  Parameters
+  ----------
+  dbfile: str
+    The path to the SQLite file
+  schema_version: int
+    The schema version stored in the SQLite file
+  directory: str
+    The directory of the on-disk tier. If ``None``, only the in-process
+    tier is used.
+  """
+
+  def __init__(self, dbfile, schema_version, directory=None):
+    self.dbfile = os.path.abspath(dbfile)
+    self.schema_version = schema_version
+    self.fingerprint = fingerprint(dbfile, schema_version)
+    self.directory = directory
+    if directory is not None:
+      register(dbfile, directory)
+
+  def stale(self):
+    """Returns whether the SQLite file changed since the cache was created"""
+    try:
+      return fingerprint(self.dbfile, self.schema_version) != self.fingerprint
+    except OSError:
+      return True
+
+  def key(self, **parameters):
+    """Returns the key corresponding to the given query parameters"""
+    description = json.dumps([self.dbfile, self.fingerprint, parameters], sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+  def _path(self, key):
+    return os.path.join(self.directory, key + '.json')
+
+  def get(self, key):
+    """Returns the entries stored for the key, or ``None`` on a miss"""
+    if key in _memory:
+      return _memory[key]
+    if self.directory is None:
+      return None
+    try:
+      with open(self._path(key)) as f:
+        entries = json.load(f)
+    except (IOError, OSError, ValueError):
+      return None
+    _memory[key] = entries
+    return entries
+
+  def set(self, key, entries):
+    """Stores the entries for the key, in both tiers"""
+    _memory[key] = entries
+    if self.directory is None:
+      return
+    try:
+      if not os.path.exists(self.directory):
+        os.makedirs(self.directory)
+      # write-then-rename, so that concurrent readers never see partial files
+      fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+      with os.fdopen(fd, 'w') as f:
+        json.dump(entries, f)
+      os.replace(tmp, self._path(key))
+    except (IOError, OSError) as e:
+      logger.warn("Cannot write to the query cache {}: {}".format(self.directory, e))
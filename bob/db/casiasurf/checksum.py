@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Content checksums of the image files
+
+Checksums are computed when the database is created (see the
+``--checksums`` option of ``create``), and image files can then be verified
+against them. Verification is incremental: the size and modification time
+of the files verified so far are kept in a state file, and files that did
+not change since their last successful verification are skipped.
+"""
+
+import os
+import json
+import hashlib
+import tempfile
+
+import bob.core
+logger = bob.core.log.setup('bob.db.casiasurf')
+
+
+def new_hash():
+  """Returns a new hash object, of the algorithm of the checksums"""
+  return hashlib.blake2b(digest_size=16)
+
+
+def file_checksum(filename, chunk_size=1024 * 1024):
+  """Computes the (BLAKE2b, 128 bits) checksum of the contents of a file
+
+  Parameters
+  ----------
+  filename: str
+    The file
+
+  Returns
+  -------
+  str:
+    The hexadecimal digest
+  """
+  h = new_hash()
+  with open(filename, 'rb') as f:
+    for chunk in iter(lambda: f.read(chunk_size), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+def compute_checksums(filenames, jobs=1):
+  """Computes the checksums of files in parallel threads
+
+  Returns
+  -------
+  list:
+    The checksums, in the order of the files
+  """
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool(jobs)
+  try:
+    return pool.map(file_checksum, filenames, chunksize=64)
+  finally:
+    pool.close()
+    pool.join()
+
+
+def _load_state(state_file):
+  if state_file is None or not os.path.exists(state_file):
+    return {}
+  try:
+    with open(state_file) as f:
+      return json.load(f)
+  except (IOError, OSError, ValueError):
+    logger.warn("Ignoring the unreadable verification state {}".format(state_file))
+    return {}
+
+
+def _save_state(state_file, state):
+  directory = os.path.dirname(os.path.abspath(state_file))
+  fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+  with os.fdopen(fd, 'w') as f:
+    json.dump(state, f)
+  os.replace(tmp, state_file)
+
+
+def verify(files, state_file=None, jobs=1, full=False):
+  """Verifies the checksums of files
+
+  Parameters
+  ----------
+  files: list of tuple
+    The (path, checksum) of the files to verify. Files without checksum
+    (``None``) cannot be verified, and are reported separately.
+  state_file: str
+    The file where the size and modification time of the successfully
+    verified files are kept. If ``None``, all files are verified.
+  jobs: int
+    The number of parallel threads
+  full: bool
+    If set, all files are verified, even the unchanged ones
+
+  Returns
+  -------
+  tuple:
+    The lists of the paths of the files that are missing, and of the files
+    whose contents do not match their checksum, the number of files that
+    were skipped, and the list of the paths of the files without checksum
+  """
+  from multiprocessing.pool import ThreadPool
+
+  state = {} if full else _load_state(state_file)
+  missing = []
+  unverifiable = []
+  to_verify = []
+  stats = {}
+  for path, checksum in files:
+    if checksum is None:
+      unverifiable.append(path)
+      continue
+    try:
+      stat = os.stat(path)
+    except OSError:
+      missing.append(path)
+      continue
+    stats[path] = [stat.st_size, stat.st_mtime_ns, checksum]
+    if state.get(path) != stats[path]:
+      to_verify.append((path, checksum))
+
+  skipped = len(files) - len(missing) - len(to_verify) - len(unverifiable)
+  logger.info("Verifying {} files ({} unchanged files skipped)".format(len(to_verify), skipped))
+
+  def check(f):
+    path, checksum = f
+    return file_checksum(path) == checksum
+
+  pool = ThreadPool(jobs)
+  try:
+    results = pool.map(check, to_verify, chunksize=64)
+  finally:
+    pool.close()
+    pool.join()
+
+  mismatches = []
+  for (path, _), ok in zip(to_verify, results):
+    if ok:
+      state[path] = stats[path]
+    else:
+      state.pop(path, None)
+      mismatches.append(path)
+  for path in missing:
+    state.pop(path, None)
+
+  if state_file is not None:
+    _save_state(state_file, state)
+  if unverifiable:
+    logger.warn("{} files have no checksum, and were not verified".format(len(unverifiable)))
+  return missing, mismatches, skipped, unverifiable
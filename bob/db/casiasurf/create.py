@@ -8,6 +8,7 @@ import glob
 from bob.db.base.driver import Interface as BaseInterface
 
 import bob.core
+import bob.io.base
 logger = bob.core.log.setup('bob.db.casiasurf')
 
 
@@ -38,7 +39,7 @@ def get_labels(label_filename):
       dict_labels[stem] = label
   return dict_labels
 
-def add_samples(session, imagesdir, validation_label_filename, test_label_filename, extension='.jpg'):
+def add_samples(session, imagesdir, validation_label_filename, test_label_filename, extension='.jpg', split=None):
   """ Add samples
 
   A sample is an instance of an example of the CASIA-SURF database.
@@ -61,6 +62,9 @@ def add_samples(session, imagesdir, validation_label_filename, test_label_filena
     The filename for the test set (with labels)
   extension: :py:obj:str
     The extension of the image file.
+  split: str
+    If given, only the samples of this split ('Training', 'Val' or
+    'Testing') are added
   
   """
 
@@ -77,7 +81,7 @@ def add_samples(session, imagesdir, validation_label_filename, test_label_filena
   # get dictionary for test labels
   test_dict = get_labels(test_label_filename)
 
-  for root, dirs, files in os.walk(imagesdir, topdown=False):
+  for root, dirs, files in os.walk(os.path.join(imagesdir, split) if split else imagesdir, topdown=False):
     for name in files:
       image_filename = os.path.join(root, name)
 
@@ -107,6 +111,11 @@ def add_samples(session, imagesdir, validation_label_filename, test_label_filena
             n_training_real_samples += 1
           
           sample_id = infos[2] + '-type-' + str(attack_type) + '-image-' + infos[5].split('.')[0]
+
+          # the subject and video are given by the directory tree
+          subject = infos[2]
+          video = infos[2] + '/' + infos[3]
+          frame = int(infos[5].split('.')[0])
         
         ##################
         ### VALIDATION ###
@@ -133,6 +142,11 @@ def add_samples(session, imagesdir, validation_label_filename, test_label_filena
           
           sample_id = 'val-' + temp[0] + '-type-' + str(attack_type)
 
+          # subjects are anonymised, the video is the directory of the frame
+          subject = None
+          video = 'val-' + infos[1]
+          frame = int(temp[0])
+
         ###############
         ### TESTING ###
         ###############
@@ -159,8 +173,13 @@ def add_samples(session, imagesdir, validation_label_filename, test_label_filena
           if stream == 'depth': modality = 'depth'
           
           sample_id = 'test-' + temp[0] + '-type-' + str(attack_type)
+
+          # subjects are anonymised, the video is the directory of the frame
+          subject = None
+          video = 'test-' + infos[1]
+          frame = int(temp[0])
         
-        o = Sample(sample_id, group, attack_type)
+        o = Sample(sample_id, group, attack_type, subject, video, frame)
         q = session.query(Sample.id).filter(Sample.id==sample_id)
 
         # test if the sample corresponding to this file is already in the table
@@ -199,7 +218,7 @@ def add_samples(session, imagesdir, validation_label_filename, test_label_filena
   logger.info("Added {} attack test samples".format(n_test_attack_samples))
 
 
-def add_files(session, imagesdir, validation_label_filename, test_label_filename, extension='.jpg'):
+def add_files(session, imagesdir, validation_label_filename, test_label_filename, extension='.jpg', split=None):
   """ Add face images files.
 
   This function adds the face image files to the database.
@@ -216,6 +235,9 @@ def add_files(session, imagesdir, validation_label_filename, test_label_filename
     The filename for the test set (with labels)
   extension: :py:obj:str
     The extension of the image file.
+  split: str
+    If given, only the files of this split ('Training', 'Val' or
+    'Testing') are added
 
   """
 
@@ -230,7 +252,7 @@ def add_files(session, imagesdir, validation_label_filename, test_label_filename
   valid_dict = get_labels(validation_label_filename)
   test_dict = get_labels(test_label_filename)
 
-  for root, dirs, files in os.walk(imagesdir, topdown=False):
+  for root, dirs, files in os.walk(os.path.join(imagesdir, split) if split else imagesdir, topdown=False):
     for name in files:
       image_filename = os.path.join(root, name)
 
@@ -321,6 +343,38 @@ def add_files(session, imagesdir, validation_label_filename, test_label_filename
   logger.info("Added {} attack test images".format(n_test_attack_images))
 
 
+PROTOCOLS = ('all', 'color', 'infrared', 'depth')
+
+GROUP_PURPOSES = (('train', 'real'), ('train', 'attack'), ('validation', 'real'), ('validation', 'attack'), ('test', 'real'), ('test', 'attack'))
+
+# associates each protocol purpose with the samples of its group and purpose
+PROTOCOL_SAMPLES = """INSERT INTO "protocolPurpose_file_association" ("protocolPurpose_id", sample_id)
+  SELECT pu.id, s.id FROM "protocolPurpose" pu JOIN sample s ON s."group" = pu."group"
+  WHERE (pu.purpose = 'real' AND s.attack_type = 0) OR (pu.purpose = 'attack' AND s.attack_type > 0)
+  ORDER BY pu.id, s.id"""
+
+
+def protocol_statements():
+  """Returns the SQL statements which fill the protocol tables
+
+  The samples are associated with the protocol purposes with a single
+  ``INSERT ... SELECT``, from their group and attack type.
+
+  Returns
+  -------
+  list:
+    The statements, and their (named) parameters
+  """
+  statements = []
+  for protocol_name in PROTOCOLS:
+    statements.append(('INSERT INTO protocol (name) VALUES (:name)', dict(name=protocol_name)))
+    for group, purpose in GROUP_PURPOSES:
+      statements.append(('INSERT INTO "protocolPurpose" (protocol_id, "group", purpose) '
+          'SELECT id, :group, :purpose FROM protocol WHERE name = :name', dict(name=protocol_name, group=group, purpose=purpose)))
+  statements.append((PROTOCOL_SAMPLES, {}))
+  return statements
+
+
 def add_protocols(session):
   """
 
@@ -333,42 +387,316 @@ def add_protocols(session):
     The session to the SQLite database 
   """
 
-  from sqlalchemy import and_
+  from sqlalchemy import text
+
+  logger.info("Adding protocols {}...".format(', '.join(PROTOCOLS)))
+  for statement, params in protocol_statements():
+    result = session.execute(text(statement), params)
+  logger.info("added {} protocol samples".format(result.rowcount))
+
+
+def read_image_header(filename):
+  """ Reads the dimensions of an image from its header only
+
+  JPEG headers are parsed directly, up to the start of frame marker. Other
+  images are handled by :py:func:`bob.io.base.peek`.
+
+  Parameters
+  ----------
+  filename: str
+    The image file
+
+  Returns
+  -------
+  tuple:
+    The width, height and number of channels of the image, and the size
+    of the file (in bytes). Values that cannot be read (e.g. the dimensions
+    of a truncated or corrupted image) are ``None``.
+  
+  """
+  import struct
+
+  try:
+    file_size = os.path.getsize(filename)
+  except OSError as e:
+    logger.warn("Cannot read the image file {}: {}".format(filename, e))
+    return None, None, None, None
+
+  try:
+    return _read_dimensions(filename) + (file_size,)
+  except (struct.error, IOError, RuntimeError, ValueError) as e:
+    # e.g. a truncated header, or a file which is not an image
+    logger.warn("Cannot read the dimensions of the image {}: {}".format(filename, e))
+    return None, None, None, file_size
+
+
+def _read_dimensions(filename):
+  """Returns the width, height and number of channels of an image"""
+  import struct
+
+  with open(filename, 'rb') as f:
+    if f.read(2) == b'\xff\xd8':
+      while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xff:
+          break
+        code = marker[1]
+        if code == 0xff:
+          # fill byte
+          f.seek(-1, 1)
+          continue
+        if code == 0x01 or 0xd0 <= code <= 0xd8:
+          # markers without payload
+          continue
+        length = struct.unpack('>H', f.read(2))[0]
+        if 0xc0 <= code <= 0xcf and code not in (0xc4, 0xc8, 0xcc):
+          _, height, width, channels = struct.unpack('>BHHB', f.read(6))
+          return width, height, channels
+        f.seek(length - 2, 1)
+
+  _, shape, _ = bob.io.base.peek(filename)
+  if len(shape) == 3:
+    return shape[2], shape[1], shape[0]
+  return shape[1], shape[0], 1
+
+
+def add_modalities(session):
+  """ Add the bitmask of the available modalities of each sample
 
-  modalities = ['all', 'color', 'infrared', 'depth']
+  Parameters
+  ----------
+  session:
+    The session to the SQLite database 
   
-  group_purpose_list = [('train', 'real'), ('train', 'attack'), ('validation', 'real'), ('validation', 'attack'), ('test', 'real'), ('test', 'attack')]
+  """
+  masks = {}
+  for sample_id, modality in session.query(ImageFile.sample_id, ImageFile.modality).distinct():
+    masks[sample_id] = masks.get(sample_id, 0) | MODALITY_BITS[modality]
 
+  n_incomplete = 0
+  mappings = []
+  for (sample_id,) in session.query(Sample.id):
+    mask = masks.get(sample_id, 0)
+    if mask != COMPLETE_MODALITIES:
+      n_incomplete += 1
+      logger.debug("Sample {} is incomplete (modalities {})".format(sample_id, mask))
+    mappings.append(dict(id=sample_id, modalities=mask))
+  session.bulk_update_mappings(Sample, mappings)
+  logger.info("{} samples do not have all modalities".format(n_incomplete))
 
-  for protocol_name in modalities:
-    
-    p = Protocol(protocol_name)
-    logger.info("Adding protocol {}...".format(protocol_name))
-    session.add(p)
-    session.flush()
-    session.refresh(p)
 
-    for group_purpose in group_purpose_list: 
+def add_image_headers(session, imagesdir, extension='.jpg', jobs=1):
+  """ Add the dimensions of the images
 
-      group = group_purpose[0]
-      purpose = group_purpose[1]
-      pu = ProtocolPurpose(p.id, group, purpose)
-    
-      logger.info("  Adding protocol purpose ({}, {})...".format(group, purpose))
-      session.add(pu)
-      session.flush()
-      session.refresh(pu)
+  Only the headers of the images are read (in parallel threads), and the
+  width, height, number of channels and file size are stored for each file.
 
-      # first retrieve all files for the group and the purpose 
-      if purpose == 'real':
-        q = session.query(Sample).filter(and_(Sample.group == group, Sample.attack_type == 0)).order_by(Sample.id)
-      if purpose == 'attack':
-        q = session.query(Sample).filter(and_(Sample.group == group, Sample.attack_type > 0)).order_by(Sample.id)
+  Parameters
+  ----------
+  session:
+    The session to the SQLite database 
+  imagesdir : :py:obj:str
+    The directory where to find the images 
+  extension: :py:obj:str
+    The extension of the image file.
+  jobs: int
+    The number of parallel threads
+  
+  """
+  from multiprocessing.pool import ThreadPool
+
+  files = session.query(ImageFile.id, ImageFile.path).order_by(ImageFile.id).all()
+  filenames = [os.path.join(imagesdir, path + extension) for _, path in files]
+
+  pool = ThreadPool(jobs)
+  try:
+    headers = pool.map(read_image_header, filenames, chunksize=256)
+  finally:
+    pool.close()
+    pool.join()
+
+  session.bulk_update_mappings(ImageFile, [
+    dict(id=file_id, width=width, height=height, channels=channels, file_size=file_size)
+    for (file_id, _), (width, height, channels, file_size) in zip(files, headers)])
+  logger.info("Added the dimensions of {} images".format(len(files)))
 
-      # now add the samples
-      for k in q:
-        pu.samples.append(k)
-      logger.info("added {} samples".format(len(list(q))))
+
+def add_checksums(session, imagesdir, extension='.jpg', jobs=1):
+  """ Add the checksums of the image files
+
+  Parameters
+  ----------
+  session:
+    The session to the SQLite database 
+  imagesdir : :py:obj:str
+    The directory where to find the images 
+  extension: :py:obj:str
+    The extension of the image file.
+  jobs: int
+    The number of parallel threads
+  
+  """
+  from .checksum import compute_checksums
+
+  files = session.query(ImageFile.id, ImageFile.path).order_by(ImageFile.id).all()
+  checksums = compute_checksums([os.path.join(imagesdir, path + extension) for _, path in files], jobs)
+  session.bulk_update_mappings(ImageFile, [
+    dict(id=file_id, checksum=checksum) for (file_id, _), checksum in zip(files, checksums)])
+  logger.info("Added the checksums of {} images".format(len(files)))
+
+
+def add_annotations(session, annotation_directory, annotation_extension='.json'):
+  """ Add face annotations
+
+  The annotations of each image file are read once (from JSON files
+  containing the ``topleft`` and ``bottomright`` corners of the face), and
+  stored in the database, so that they can be retrieved in bulk.
+
+  Parameters
+  ----------
+  session:
+    The session to the SQLite database 
+  annotation_directory: str
+    The directory where to find the annotations
+  annotation_extension: str
+    The extension of the annotation files
+  
+  """
+  import bob.db.base
+
+  n_annotations = 0
+  n_missing = 0
+  for file_id, path in session.query(ImageFile.id, ImageFile.path).order_by(ImageFile.id).all():
+    annotation_filename = os.path.join(annotation_directory, path + annotation_extension)
+    if not os.path.exists(annotation_filename):
+      n_missing += 1
+      logger.debug("No annotation for file {}".format(path))
+      continue
+    annotations = bob.db.base.read_annotation_file(annotation_filename, 'json')
+    if 'topleft' in annotations and 'bottomright' in annotations:
+      session.add(Annotation(file_id, annotations['topleft'], annotations['bottomright']))
+      n_annotations += 1
+    else:
+      n_missing += 1
+      logger.debug("No face in annotation file {}".format(annotation_filename))
+
+  logger.info("Added {} annotations ({} files are not annotated)".format(n_annotations, n_missing))
+
+
+def set_schema_version(session):
+  """Stores the schema version as the SQLite user_version of the file
+
+  Parameters
+  ----------
+  session:
+    The session to the SQLite database 
+  """
+  from sqlalchemy import text
+  session.execute(text('PRAGMA user_version = %d' % SCHEMA_VERSION))
+
+
+# the splits of the database, i.e. the top-level directories of the tree
+SPLITS = ('Training', 'Val', 'Testing')
+
+# tables filled by the build of each split, and their column referencing an
+# image file (i.e. to remap when merging the splits)
+SPLIT_TABLES = (
+  (Sample.__table__, None),
+  (ImageFile.__table__, 'id'),
+  (sample_file_association, 'file_id'),
+  (Annotation.__table__, 'file_id'),
+)
+
+
+def create_split(task):
+  """Builds the samples and files of a single split into their own SQLite file
+
+  Parameters
+  ----------
+  task: tuple
+    The SQLite file to create, the split, and the arguments of ``create``
+
+  Returns
+  -------
+  dict:
+    The metrics of the stages, see :py:meth:`bob.db.casiasurf.metrics.Metrics.snapshot`
+  """
+  from bob.db.base.utils import session_try_nolock, create_engine_try_nolock
+  from .metrics import registry as metrics
+
+  splitfile, split, args = task
+  # a forked worker inherits the metrics of the parent
+  metrics.reset()
+  bob.core.log.set_verbosity_level(logger, args.verbose)
+  Base.metadata.create_all(create_engine_try_nolock(args.type, splitfile))
+  s = session_try_nolock(args.type, splitfile, echo=False)
+  with metrics.timer('create.files'):
+    add_files(s, args.imagesdir, args.validlabel, args.testlabel, split=split)
+  with metrics.timer('create.samples'):
+    add_samples(s, args.imagesdir, args.validlabel, args.testlabel, split=split)
+  with metrics.timer('create.modalities'):
+    add_modalities(s)
+  with metrics.timer('create.image_headers'):
+    add_image_headers(s, args.imagesdir, jobs=args.jobs)
+  if args.checksums:
+    with metrics.timer('create.checksums'):
+      add_checksums(s, args.imagesdir, jobs=args.jobs)
+  if args.annotations_dir:
+    with metrics.timer('create.annotations'):
+      add_annotations(s, args.annotations_dir, args.annotations_ext)
+  with metrics.timer('create.commit'):
+    s.commit()
+  s.close()
+  return metrics.snapshot()
+
+
+def merge_splits(dbfile, splitfiles):
+  """Merges the SQLite files of the splits into the database
+
+  Each file is attached to the database, and its rows are copied with
+  ``INSERT ... SELECT``. Sample ids are unique across splits, but the
+  (integer) ids of the image files are shifted after the ones already
+  merged. The stores indexed by these ids (the query caches and the
+  thumbnail store of the database) are then removed. The protocols are
+  also added, as by :py:func:`add_protocols`.
+
+  Parameters
+  ----------
+  dbfile: str
+    The SQLite file of the database, with its tables already created
+  splitfiles: list of str
+    The SQLite files of the splits, see :py:func:`create_split`
+  """
+  import sqlite3
+
+  connection = sqlite3.connect(dbfile, isolation_level=None)
+  try:
+    for splitfile in splitfiles:
+      connection.execute('ATTACH DATABASE ? AS split', (splitfile,))
+      connection.execute('BEGIN')
+      offset = connection.execute('SELECT COALESCE(MAX(id), 0) FROM main.imagefile').fetchone()[0]
+      for table, file_column in SPLIT_TABLES:
+        columns = [c.name for c in table.columns]
+        selected = ['"%s" + %d' % (c, offset) if c == file_column else '"%s"' % c for c in columns]
+        connection.execute('INSERT INTO main."%s" (%s) SELECT %s FROM split."%s"' % (
+          table.name, ', '.join('"%s"' % c for c in columns), ', '.join(selected), table.name))
+      connection.execute('COMMIT')
+      connection.execute('DETACH DATABASE split')
+      logger.info("Merged {} (image file ids shifted by {})".format(splitfile, offset))
+
+    connection.execute('BEGIN')
+    for statement, params in protocol_statements():
+      cursor = connection.execute(statement, params)
+    connection.execute('COMMIT')
+    logger.info("Added {} protocol samples".format(cursor.rowcount))
+  finally:
+    connection.close()
+
+  # the image file ids changed
+  from .cache import clear_all
+  from . import thumbnails
+  clear_all(dbfile)
+  thumbnails.remove(thumbnails.default_directory(dbfile))
 
 
 def create_tables(args):
@@ -401,16 +729,85 @@ def create(args):
 
   bob.core.log.set_verbosity_level(logger, args.verbose)
 
+  from .metrics import registry as metrics
+  before = metrics.snapshot()['latencies']
+
   # the real work...
   create_tables(args)
-  s = session_try_nolock(args.type, args.files[0], echo=False)
-  
-  add_files(s, args.imagesdir, args.validlabel, args.testlabel)
-  add_samples(s, args.imagesdir, args.validlabel, args.testlabel)
-  add_protocols(s)
-  s.commit()
+  splits = [split for split in SPLITS if os.path.isdir(os.path.join(args.imagesdir, split))]
+
+  if args.serial or len(splits) < 2:
+    s = session_try_nolock(args.type, args.files[0], echo=False)
+    with metrics.timer('create.files'):
+      add_files(s, args.imagesdir, args.validlabel, args.testlabel)
+    with metrics.timer('create.samples'):
+      add_samples(s, args.imagesdir, args.validlabel, args.testlabel)
+    with metrics.timer('create.modalities'):
+      add_modalities(s)
+    with metrics.timer('create.image_headers'):
+      add_image_headers(s, args.imagesdir, jobs=args.jobs)
+    if args.checksums:
+      with metrics.timer('create.checksums'):
+        add_checksums(s, args.imagesdir, jobs=args.jobs)
+    if args.annotations_dir:
+      with metrics.timer('create.annotations'):
+        add_annotations(s, args.annotations_dir, args.annotations_ext)
+    with metrics.timer('create.protocols'):
+      add_protocols(s)
+
+  else:
+    # the merge also adds the protocols
+    # each split is built by its own process (and SQLite writer), and the
+    # splits are then merged
+    import shutil
+    import tempfile
+    import multiprocessing
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(dbfile))
+    try:
+      splitfiles = [os.path.join(tmpdir, split + '.sql3') for split in splits]
+      pool = multiprocessing.Pool(len(splits))
+      try:
+        with metrics.timer('create.splits'):
+          snapshots = pool.map(create_split, [(f, split, args) for f, split in zip(splitfiles, splits)], chunksize=1)
+      finally:
+        pool.close()
+        pool.join()
+      with metrics.timer('create.merge'):
+        merge_splits(dbfile, splitfiles)
+    finally:
+      shutil.rmtree(tmpdir)
+    # the stages of the splits are summed over their processes
+    for snapshot in snapshots:
+      metrics.merge(snapshot)
+    s = session_try_nolock(args.type, args.files[0], echo=False)
+
+  set_schema_version(s)
+  with metrics.timer('create.commit'):
+    s.commit()
   s.close()
 
+  # results memoised for the previous database are stale
+  from .cache import clear_all
+  clear_all(dbfile)
+
+  # thumbnails are indexed by the ids of the files, which changed
+  from . import thumbnails
+  if args.thumbnails_size:
+    s = session_try_nolock(args.type, args.files[0], echo=False)
+    with metrics.timer('create.thumbnails'):
+      thumbnails.build(s, args.imagesdir, thumbnails.default_directory(dbfile), dbfile,
+          size=(args.thumbnails_size, args.thumbnails_size),
+          jobs=args.jobs)
+    s.close()
+  else:
+    thumbnails.remove(thumbnails.default_directory(dbfile))
+
+  # durations of the stages of this run only
+  for name, latency in sorted(metrics.snapshot()['latencies'].items()):
+    if name.startswith('create.'):
+      duration = latency['sum'] - before.get(name, {}).get('sum', 0.)
+      logger.info("Stage {} took {:.3f}s".format(name[len('create.'):], duration))
+
   return 0
 
 
@@ -423,6 +820,18 @@ def add_command(subparsers):
                       help="If set, I'll first erase the current database")
   parser.add_argument('-v', '--verbose', action='count', default=0,
                       help="Do SQL operations in a verbose way")
+  parser.add_argument('-t', '--thumbnails-size', type=int, default=0, metavar='SIZE',
+                      help="If set, I'll also precompute the face thumbnails, of SIZExSIZE pixels")
+  parser.add_argument('-c', '--checksums', action='store_true', default=False,
+                      help="If set, I'll also compute the checksums of the images (see the 'verify' command)")
+  parser.add_argument('-a', '--annotations-dir', metavar='DIR',
+                      help="If set, I'll also store the annotations of the images, found in this directory")
+  parser.add_argument('--annotations-ext', default='.json', metavar='EXT',
+                      help="The extension of the annotation files")
+  parser.add_argument('-j', '--jobs', type=int, default=1,
+                      help="The number of parallel processes (or threads) to use")
+  parser.add_argument('--serial', action='store_true', default=False,
+                      help="If set, the splits are built one after the other into the database, instead of in parallel processes")
   parser.add_argument('imagesdir', action='store', metavar='DIR',
                       help="The path to the extracted images of the database")
   parser.add_argument('validlabel', action='store', metavar='FILE',
@@ -19,6 +19,8 @@ def dumplist(args):
       protocol=args.protocol,
       purposes=args.purpose,
       groups=args.group,
+      shard_index=args.shard_index,
+      num_shards=args.num_shards,
   )
 
   output = sys.stdout
@@ -26,8 +28,9 @@ def dumplist(args):
     from bob.db.base.utils import null
     output = null()
 
-  for f in r:
-    output.write('%s\n' % f.make_path(directory=args.directory,extension=args.extension))
+  for s in r:
+    for f in s.files:
+      output.write('%s\n' % f.make_path(directory=args.directory,extension=args.extension))
 
   return 0
 
@@ -42,9 +45,10 @@ def checkfiles(args):
   # go through all files, check if they are available on the filesystem
   good = []
   bad = []
-  for f in r:
-    if os.path.exists(f.make_path(args.directory, args.extension)): good.append(f)
-    else: bad.append(f)
+  for s in r:
+    for f in s.files:
+      if os.path.exists(f.make_path(args.directory, args.extension)): good.append(f)
+      else: bad.append(f)
 
   # report
   output = sys.stdout
@@ -56,7 +60,164 @@ def checkfiles(args):
     for f in bad:
       output.write('Cannot find file "%s"\n' % f.make_path(args.directory, args.extension))
     output.write('%d files (out of %d) were not found at "%s"\n' % \
-        (len(bad), len(r), args.directory))
+        (len(bad), len(good) + len(bad), args.directory))
+
+  return 0
+
+def export_metadata(args):
+  """Exports the metadata of the files as a Parquet, Arrow or CSV table"""
+
+  from .query import Database
+  db = Database()
+
+  db.export_metadata(
+      args.output,
+      format=args.format,
+      protocol=args.protocol,
+      purposes=args.purpose,
+      groups=args.group,
+  )
+
+  return 0
+
+def stats(args):
+  """Prints the number of samples and files by group, purpose, attack type and modality"""
+
+  from .query import Database
+  db = Database()
+
+  rows = db.stats(
+      protocol=args.protocol,
+      purposes=args.purpose,
+      groups=args.group,
+      with_bytes=args.bytes,
+  )
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  if args.json:
+    import json
+    json.dump(rows, output, indent=2)
+    output.write('\n')
+    return 0
+
+  columns = ('group', 'purpose', 'attack_type', 'modality', 'samples', 'files')
+  if args.bytes:
+    columns += ('bytes',)
+  output.write(''.join('%-12s' % c for c in columns).rstrip() + '\n')
+  for row in rows:
+    output.write(''.join('%-12s' % (row[c],) for c in columns).rstrip() + '\n')
+
+  return 0
+
+def warm(args):
+  """Prefetches the image files of a protocol split (page cache or local scratch)"""
+
+  from .query import Database
+  db = Database(scratch_directory=args.scratch, scratch_size=args.scratch_size)
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  def progress(n_files, n_bytes, total):
+    if n_files % 1000 == 0 or n_files == total:
+      output.write('%d/%d files (%.1f MB)\n' % (n_files, total, n_bytes / 1e6))
+
+  db.prefetch(
+      protocol=args.protocol,
+      groups=args.group,
+      purposes=args.purpose,
+      modality=args.modality or 'all',
+      directory=args.directory,
+      extension=args.extension,
+      jobs=args.jobs,
+      max_bandwidth=args.max_bandwidth * 1e6 if args.max_bandwidth else None,
+      callback=progress,
+      wait=True,
+  )
+
+  return 0
+
+def verify(args):
+  """Verifies the checksums of the image files"""
+
+  from .query import Database
+  db = Database()
+
+  try:
+    missing, mismatches, skipped, unverifiable = db.verify(
+        directory=args.directory,
+        extension=args.extension,
+        protocol=args.protocol,
+        groups=args.group,
+        purposes=args.purpose,
+        state_file=args.state,
+        jobs=args.jobs,
+        full=args.full,
+    )
+  except ValueError as e:
+    sys.stderr.write('%s\n' % e)
+    return 1
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  for f in missing:
+    output.write('Cannot find file "%s"\n' % f)
+  for f in mismatches:
+    output.write('Checksum mismatch for file "%s"\n' % f)
+  for f in unverifiable:
+    output.write('No checksum for file "%s"\n' % f)
+  output.write('%d files missing, %d files corrupted, %d unchanged files skipped, %d files without checksum\n' % (len(missing), len(mismatches), skipped, len(unverifiable)))
+
+  return 1 if missing or mismatches else 0
+
+def bench(args):
+  """Measures the throughput of the loading of the samples"""
+
+  from .query import Database
+  from .bench import run
+  db = Database(original_directory=args.directory, original_extension=args.extension)
+
+  report = run(
+      db,
+      protocol=args.protocol,
+      groups=args.group,
+      purposes=args.purpose,
+      modality=args.modality or 'all',
+      num_samples=args.num_samples,
+      workers=args.workers,
+      size=(args.size, args.size) if args.size else None,
+      gray=args.gray,
+      pool=args.pool,
+      locality=args.locality,
+  )
+
+  output = sys.stdout
+  if args.selftest:
+    from bob.db.base.utils import null
+    output = null()
+
+  if args.json:
+    import json
+    output.write(json.dumps(report, indent=2, sort_keys=True) + '\n')
+    return 0
+
+  output.write('%d samples loaded by %d workers in %.2fs (query: %.2fs)\n' % (report['samples'], report['workers'], report['wall'], report['query']))
+  if report['pool'] is not None:
+    output.write('the files were first read into memory in %.2fs\n' % report['pool'])
+  output.write('%.1f samples/s, %.1f MB/s\n' % (report['samples_per_second'] or 0, report['mb_per_second'] or 0))
+  output.write('latency per sample: p50 %.1fms, p99 %.1fms\n' % (report['p50'] * 1e3, report['p99'] * 1e3))
+  total = sum(report['stages'].values())
+  for name, seconds in sorted(report['stages'].items()):
+    output.write('  %-20s %8.2fs %5.1f%%\n' % (name, seconds, 100. * seconds / total if total else 0))
 
   return 0
 
@@ -93,9 +254,11 @@ class Interface(BaseInterface):
     parser = subparsers.add_parser('dumplist', help=dumplist.__doc__)
     parser.add_argument('-d', '--directory', default='', help="if given, this path will be prepended to every entry returned.")
     parser.add_argument('-e', '--extension', default='', help="if given, this extension will be appended to every entry returned.")
-    parser.add_argument('-p', '--protocol', help="the protocol", choices=('default'))
+    parser.add_argument('-p', '--protocol', help="the protocol", choices=('all', 'color', 'infrared', 'depth'))
     parser.add_argument('-P', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes.", choices=('real', 'attack'))
-    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=('dev', 'eval', 'world'))
+    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=('train', 'validation', 'test'))
+    parser.add_argument('--shard-index', type=int, default=0, help="if given, only the samples of this shard will be listed.")
+    parser.add_argument('--num-shards', type=int, default=1, help="the number of shards the samples are split into.")
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
     parser.set_defaults(func=dumplist) #action
 
@@ -107,3 +270,68 @@ class Interface(BaseInterface):
     parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
 
     parser.set_defaults(func=checkfiles) #action
+
+    # the "export-metadata" action
+    parser = subparsers.add_parser('export-metadata', help=export_metadata.__doc__)
+    parser.add_argument('output', help="The file to write the metadata to.")
+    parser.add_argument('-f', '--format', help="The format of the file; by default, it is guessed from its extension (CSV if unknown).", choices=('parquet', 'arrow', 'csv'))
+    parser.add_argument('-p', '--protocol', help="the protocol")
+    parser.add_argument('-P', '--purpose', help="if given, this value will limit the output files to those designed for the given purposes.", choices=('real', 'attack'))
+    parser.add_argument('-g', '--group', help="if given, this value will limit the output files to those belonging to a particular protocolar group.", choices=('train', 'validation', 'test'))
+    parser.set_defaults(func=export_metadata) #action
+
+    # the "stats" action
+    parser = subparsers.add_parser('stats', help=stats.__doc__)
+    parser.add_argument('-p', '--protocol', help="the protocol")
+    parser.add_argument('-P', '--purpose', help="if given, this value will limit the statistics to the samples designed for the given purposes.", choices=('real', 'attack'))
+    parser.add_argument('-g', '--group', help="if given, this value will limit the statistics to the samples belonging to a particular protocolar group.", choices=('train', 'validation', 'test'))
+    parser.add_argument('-b', '--bytes', action='store_true', help="if given, the total size of the files is also reported.")
+    parser.add_argument('-j', '--json', action='store_true', help="if given, the statistics are written as JSON instead of a table.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=stats) #action
+
+    # the "warm" action
+    parser = subparsers.add_parser('warm', help=warm.__doc__)
+    parser.add_argument('-d', '--directory', required=True, help="The directory where the image files are stored.")
+    parser.add_argument('-e', '--extension', default='.jpg', help="The extension of the image files.")
+    parser.add_argument('-p', '--protocol', help="the protocol")
+    parser.add_argument('-P', '--purpose', help="if given, this value will limit the prefetched files to those designed for the given purposes.", choices=('real', 'attack'))
+    parser.add_argument('-g', '--group', help="if given, this value will limit the prefetched files to those belonging to a particular protocolar group.", choices=('train', 'validation', 'test'))
+    parser.add_argument('-m', '--modality', help="if given, only the files of this modality are prefetched.", choices=('color', 'infrared', 'depth'))
+    parser.add_argument('-s', '--scratch', help="if given, the files are copied to this local directory instead of only being read.")
+    parser.add_argument('--scratch-size', type=int, help="the maximum size (in bytes) of the copies in the scratch directory.")
+    parser.add_argument('-j', '--jobs', type=int, default=4, help="The number of parallel threads.")
+    parser.add_argument('-b', '--max-bandwidth', type=float, help="The maximum bandwidth, in MB/s.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=warm) #action
+
+    # the "verify" action
+    parser = subparsers.add_parser('verify', help=verify.__doc__)
+    parser.add_argument('-d', '--directory', required=True, help="The directory where the image files are stored.")
+    parser.add_argument('-e', '--extension', default='.jpg', help="The extension of the image files.")
+    parser.add_argument('-p', '--protocol', help="the protocol")
+    parser.add_argument('-P', '--purpose', help="if given, this value will limit the verified files to those designed for the given purposes.", choices=('real', 'attack'))
+    parser.add_argument('-g', '--group', help="if given, this value will limit the verified files to those belonging to a particular protocolar group.", choices=('train', 'validation', 'test'))
+    parser.add_argument('-s', '--state', help="if given, the files verified so far are kept track of in this file, and unchanged files are skipped.")
+    parser.add_argument('-f', '--full', action='store_true', help="if given, all files are verified, even the unchanged ones.")
+    parser.add_argument('-j', '--jobs', type=int, default=4, help="The number of parallel threads.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=verify) #action
+
+    # the "bench" action
+    parser = subparsers.add_parser('bench', help=bench.__doc__)
+    parser.add_argument('-d', '--directory', required=True, help="The directory where the image files are stored.")
+    parser.add_argument('-e', '--extension', default='.jpg', help="The extension of the image files.")
+    parser.add_argument('-p', '--protocol', help="the protocol")
+    parser.add_argument('-P', '--purpose', help="if given, this value will limit the loaded samples to those designed for the given purposes.", choices=('real', 'attack'))
+    parser.add_argument('-g', '--group', help="if given, this value will limit the loaded samples to those belonging to a particular protocolar group.", choices=('train', 'validation', 'test'))
+    parser.add_argument('-m', '--modality', help="if given, only the images of this modality are loaded.", choices=('color', 'infrared', 'depth'))
+    parser.add_argument('-n', '--num-samples', type=int, default=1000, help="The number of samples to load.")
+    parser.add_argument('-w', '--workers', type=int, default=1, help="The number of worker processes.")
+    parser.add_argument('-s', '--size', type=int, help="if given, the images are resized to this (square) size.")
+    parser.add_argument('--gray', action='store_true', help="if given, the images are loaded as grayscale.")
+    parser.add_argument('--pool', action='store_true', help="if given, each worker first reads the image files into memory, and the images are decoded from memory.")
+    parser.add_argument('-l', '--locality', choices=('path', 'inode'), help="if given, the samples are read in the order of their location on disk.")
+    parser.add_argument('-j', '--json', action='store_true', help="if given, the report is written as JSON.")
+    parser.add_argument('--self-test', dest="selftest", action='store_true', help=argparse.SUPPRESS)
+    parser.set_defaults(func=bench) #action
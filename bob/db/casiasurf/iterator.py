@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Resumable iteration over samples
+
+Samples are iterated in the order of their (unique) ids, by chunks fetched
+with keyset pagination. The position of an iterator is therefore fully
+described by its (validated) query parameters and the id of the last sample
+it returned: this is the *cursor* of the iterator, a small dictionary that
+can be serialised (e.g. as JSON) and from which the iteration is resumed
+without re-scanning the samples that were already processed.
+
+For sharded queries, the (window function) assignment of the samples to
+the shards is only computed once per iterator: the ids of the shard are
+fetched first, and chunks of samples are then resolved from these ids.
+"""
+
+import bisect
+import collections
+
+# version of the format of the cursors
+CURSOR_VERSION = 1
+
+
+class SampleIterator(object):
+  """Iterates over the samples of a query, see :py:meth:`bob.db.casiasurf.Database.iter_objects`
+
+  Parameters
+  ----------
+  database: :py:class:`bob.db.casiasurf.Database`
+    The database
+  filters: dict
+    The validated query parameters
+  chunk_size: int
+    The number of samples fetched by each SQL query
+  last: str
+    The id of the last sample processed, if resuming
+  position: int
+    The number of samples processed, if resuming
+  """
+
+  def __init__(self, database, filters, chunk_size=1000, last=None, position=0):
+    self.database = database
+    self.filters = filters
+    self.chunk_size = chunk_size
+    self.last = last
+    self.position = position
+    self._chunk = collections.deque()
+    self._ids = None
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if not self._chunk:
+      self._chunk = collections.deque(self._fetch())
+      if not self._chunk:
+        raise StopIteration
+    sample = self._chunk.popleft()
+    self.last = sample.id
+    self.position += 1
+    return sample
+
+  next = __next__
+
+  def _fetch(self):
+    """Fetches the next chunk of samples"""
+    from sqlalchemy.orm import selectinload
+    from .models import Sample
+    from .metrics import registry as metrics
+    with metrics.timer('iter_objects.query'):
+      if self.filters['num_shards'] > 1:
+        if self._ids is None:
+          q = self.database._objects_query(**self.filters).with_entities(Sample.id)
+          self._ids = [i for (i,) in q]
+        start = 0 if self.last is None else bisect.bisect_right(self._ids, self.last)
+        chunk = self.database.get_samples(self._ids[start:start + self.chunk_size])
+      else:
+        q = self.database._objects_query(**self.filters).options(selectinload(Sample.files))
+        if self.last is not None:
+          q = q.filter(Sample.id > self.last)
+        chunk = q.limit(self.chunk_size).all()
+    metrics.incr('iter_objects.rows', len(chunk))
+    return chunk
+
+  def cursor(self, after=None):
+    """Returns the cursor of the iterator
+
+    Parameters
+    ----------
+    after: :py:class:`bob.db.casiasurf.models.Sample` or str
+      If given, the cursor points just after this sample (or sample id)
+      instead of after the last sample returned by the iterator. This is
+      useful when samples are processed later than they are iterated (e.g.
+      with :py:meth:`bob.db.casiasurf.Database.load_stream`). The position
+      is then only informative.
+
+    Returns
+    -------
+    dict:
+      The (JSON-serialisable) cursor, see :py:meth:`bob.db.casiasurf.Database.resume`
+    """
+    last = self.last
+    if after is not None:
+      last = after if isinstance(after, str) else after.id
+    return dict(
+      version=CURSOR_VERSION,
+      filters=self.filters,
+      last=last,
+      position=self.position,
+    )
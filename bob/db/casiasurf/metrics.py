@@ -0,0 +1,201 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Counters and latency histograms of the hot paths
+
+The queries (:py:meth:`bob.db.casiasurf.Database.objects`), the loading of
+the samples (:py:meth:`bob.db.casiasurf.models.Sample.load`) and the stages
+of ``create`` record their counters and latencies in a registry, which is
+shared by all databases of a process. Each process (e.g. each data loader
+worker) has its own registry.
+
+The metrics of the current process are returned by
+:py:meth:`bob.db.casiasurf.Database.metrics`, and may also be exported as
+they are recorded, with a hook::
+
+  >>> from bob.db.casiasurf import metrics
+  >>> metrics.add_hook(lambda kind, name, value: print(kind, name, value))
+"""
+
+import os
+import time
+import bisect
+import threading
+import contextlib
+
+# upper bounds (in seconds) of the buckets of the latency histograms: 1us to ~67s
+BUCKETS = tuple(1e-6 * 2 ** k for k in range(27))
+
+
+class Histogram(object):
+  """Latencies, counted in buckets of exponentially increasing width"""
+
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.count = 0
+    self.sum = 0.
+    self.min = None
+    self.max = None
+
+  def observe(self, value):
+    self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+    self.count += 1
+    self.sum += value
+    self.min = value if self.min is None else min(self.min, value)
+    self.max = value if self.max is None else max(self.max, value)
+
+  def percentile(self, q):
+    """Returns the (upper bound of the bucket of the) ``q``-th percentile"""
+    if not self.count:
+      return None
+    rank = q / 100. * self.count
+    total = 0
+    for k, n in enumerate(self.counts):
+      total += n
+      if total >= rank and n:
+        return min(BUCKETS[k], self.max) if k < len(BUCKETS) else self.max
+    return self.max
+
+  def merge(self, summary):
+    """Adds the latencies of a summary returned by :py:meth:`as_dict`"""
+    for k, n in enumerate(summary['counts']):
+      self.counts[k] += n
+    self.count += summary['count']
+    self.sum += summary['sum']
+    for name, select in (('min', min), ('max', max)):
+      if summary[name] is not None:
+        value = getattr(self, name)
+        setattr(self, name, summary[name] if value is None else select(value, summary[name]))
+
+  def as_dict(self):
+    return dict(
+      counts=list(self.counts),
+      count=self.count,
+      sum=self.sum,
+      min=self.min,
+      max=self.max,
+      mean=self.sum / self.count if self.count else None,
+      p50=self.percentile(50),
+      p90=self.percentile(90),
+      p99=self.percentile(99),
+    )
+
+
+class Metrics(object):
+  """A thread-safe registry of counters and latency histograms
+
+  Attributes
+  ----------
+  enabled: bool
+    Whether anything is recorded. Instrumentation can be disabled by setting
+    the ``CASIASURF_METRICS`` environment variable to ``0``.
+  """
+
+  def __init__(self, enabled=True):
+    self.enabled = enabled
+    self.lock = threading.Lock()
+    self.hooks = []
+    self.counters = {}
+    self.histograms = {}
+
+  def incr(self, name, value=1):
+    """Increments a counter"""
+    if not self.enabled:
+      return
+    with self.lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+    for hook in self.hooks:
+      hook('counter', name, value)
+
+  def observe(self, name, seconds):
+    """Records a latency (in seconds)"""
+    if not self.enabled:
+      return
+    with self.lock:
+      if name not in self.histograms:
+        self.histograms[name] = Histogram()
+      self.histograms[name].observe(seconds)
+    for hook in self.hooks:
+      hook('latency', name, seconds)
+
+  @contextlib.contextmanager
+  def timer(self, name):
+    """Records the latency of a block of code"""
+    if not self.enabled:
+      yield
+      return
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start)
+
+  def snapshot(self, reset=False):
+    """Returns the current metrics
+
+    Parameters
+    ----------
+    reset: bool
+      If set, all metrics are reset after being returned
+
+    Returns
+    -------
+    dict:
+      The ``counters`` (name and value) and the ``latencies`` (name and
+      summary of the histogram, in seconds)
+    """
+    with self.lock:
+      retval = dict(
+        pid=os.getpid(),
+        counters=dict(self.counters),
+        latencies=dict((name, h.as_dict()) for name, h in self.histograms.items()),
+      )
+      if reset:
+        self.counters = {}
+        self.histograms = {}
+    return retval
+
+  def merge(self, snapshot):
+    """Adds the metrics of another registry, e.g. of a worker process
+
+    Parameters
+    ----------
+    snapshot: dict
+      The metrics returned by :py:meth:`snapshot` in the other process
+    """
+    if not self.enabled:
+      return
+    with self.lock:
+      for name, value in snapshot['counters'].items():
+        self.counters[name] = self.counters.get(name, 0) + value
+      for name, summary in snapshot['latencies'].items():
+        if name not in self.histograms:
+          self.histograms[name] = Histogram()
+        self.histograms[name].merge(summary)
+
+  def reset(self):
+    with self.lock:
+      self.counters = {}
+      self.histograms = {}
+
+
+# the registry of the current process
+registry = Metrics(enabled=os.environ.get('CASIASURF_METRICS', '1') != '0')
+
+
+def add_hook(callback):
+  """Exports the metrics as they are recorded
+
+  Parameters
+  ----------
+  callback: callable
+    Called with the kind (``'counter'`` or ``'latency'``), the name and the
+    value of each recorded metric. It may be called from several threads,
+    and should return quickly.
+  """
+  registry.hooks.append(callback)
+
+
+def remove_hook(callback):
+  """Removes a hook added with :py:func:`add_hook`"""
+  registry.hooks.remove(callback)
@@ -3,7 +3,7 @@
 
 import os
 
-from sqlalchemy import Table, Column, Integer, String, ForeignKey
+from sqlalchemy import Table, Column, Integer, Float, String, ForeignKey
 from sqlalchemy.orm import backref
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -18,6 +18,13 @@ logger = bob.core.log.setup('bob.db.casiasurf')
 
 Base = declarative_base()
 
+# version of the schema, stored as the SQLite user_version of the file
+SCHEMA_VERSION = 7
+
+# bits of each modality in Sample.modalities
+MODALITY_BITS = {'color': 1, 'infrared': 2, 'depth': 4}
+COMPLETE_MODALITIES = 7
+
 protocolPurpose_sample_association = Table('protocolPurpose_file_association', Base.metadata,
   Column('protocolPurpose_id', Integer, ForeignKey('protocolPurpose.id')),
   Column('sample_id',  Integer, ForeignKey('sample.id')))
@@ -26,6 +33,151 @@ sample_file_association = Table('sample_files_association', Base.metadata,
   Column('sample_id', String, ForeignKey('sample.id')),
   Column('file_id', Integer, ForeignKey('imagefile.id')))
 
+def modality_list(modality):
+  """Returns the list of modalities corresponding to a modality argument
+
+  Parameters
+  ----------
+  modality: str or list of str
+    'all' for all modalities, otherwise the name of the modality or a list
+    of modalities
+
+  Returns
+  -------
+  list:
+    The list of modalities
+  """
+  if isinstance(modality, str) and modality != 'all':
+    return [modality]
+  elif isinstance(modality, str) and modality == 'all':
+    return ['color', 'infrared', 'depth']
+  return list(modality)
+
+
+def modality_mask(modalities):
+  """Returns the bitmask of a list of modalities, see :py:data:`MODALITY_BITS`"""
+  mask = 0
+  for m in modalities:
+    mask |= MODALITY_BITS[m]
+  return mask
+
+
+def load_image(filename, size=None, gray=False):
+  """Loads an image, optionally resized and/or converted to grayscale
+
+  Images are decoded with ``Pillow``, as the images held in memory (see
+  :py:func:`decode_image`), so that both give the same arrays: JPEG images
+  are decoded at a reduced resolution (downscaling in the DCT domain) and
+  directly as grayscale, and are then resized with a bilinear
+  interpolation. Images in formats that ``Pillow`` cannot read are loaded
+  with :py:func:`bob.io.base.load`, and then converted and resized the same
+  way.
+
+  Parameters
+  ----------
+  filename: str
+    The image file
+  size: tuple
+    The (height, width) of the returned image. If ``None``, the image is
+    not resized.
+  gray: bool
+    Whether to return a grayscale image
+
+  Returns
+  -------
+  :py:class:`numpy.ndarray`:
+    The image, in Bob's format: (3, height, width) for color images or
+    (height, width) for grayscale images
+  """
+  from PIL import Image
+
+  try:
+    image = Image.open(filename)
+  except IOError:
+    # not an image format known to Pillow
+    image = _to_pil(bob.io.base.load(filename))
+  return _decode_pil(image, size, gray)
+
+
+def decode_image(buffer, size=None, gray=False):
+  """Decodes an encoded image held in memory
+
+  Images are decoded as by :py:func:`load_image`, which options are the
+  same.
+
+  Parameters
+  ----------
+  buffer: bytes-like
+    The contents of the image file (e.g. a :py:class:`memoryview`)
+  size: tuple
+    The (height, width) of the returned image. If ``None``, the image is
+    not resized.
+  gray: bool
+    Whether to return a grayscale image
+
+  Returns
+  -------
+  :py:class:`numpy.ndarray`:
+    The image, in Bob's format
+  """
+  import io
+  from PIL import Image
+  return _decode_pil(Image.open(io.BytesIO(buffer)), size, gray)
+
+
+def _to_pil(data):
+  """Converts an image in Bob's format into a Pillow image"""
+  from PIL import Image
+  return Image.fromarray(data.transpose(1, 2, 0) if data.ndim == 3 else data)
+
+
+def _decode_pil(image, size, gray):
+  """Decodes an opened Pillow image into Bob's format"""
+  import numpy
+  from PIL import Image
+  if gray or image.mode == 'L':
+    mode = 'L'
+  elif image.mode in ('RGB', 'RGBA', 'CMYK', 'YCbCr', 'P'):
+    mode = 'RGB'
+  else:
+    # e.g. 16-bit grayscale, kept as is
+    mode = image.mode
+  if size is not None or mode == 'L':
+    # JPEG only: decodes directly as grayscale, and at the smallest scale
+    # larger than the requested size
+    image.draft(mode, image.size if size is None else (size[1], size[0]))
+  if image.mode != mode:
+    image = image.convert(mode)
+  if size is not None and image.size != (size[1], size[0]):
+    image = image.resize((size[1], size[0]), Image.BILINEAR)
+  data = numpy.asarray(image)
+  return data.transpose(2, 0, 1).copy() if data.ndim == 3 else data.copy()
+
+
+def resize_image(data, size):
+  """Resizes an image (in Bob's format) with a bilinear interpolation
+
+  The interpolation is the same as the one used when loading resized
+  images, see :py:func:`load_image`.
+
+  Parameters
+  ----------
+  data: :py:class:`numpy.ndarray`
+    The image, of shape (3, height, width) or (height, width)
+  size: tuple
+    The (height, width) of the returned image
+
+  Returns
+  -------
+  :py:class:`numpy.ndarray`:
+    The resized image
+  """
+  import numpy
+  from PIL import Image
+  resized = numpy.asarray(_to_pil(data).resize((size[1], size[0]), Image.BILINEAR))
+  return resized.transpose(2, 0, 1).copy() if data.ndim == 3 else resized
+
+
 class Sample(Base):
   """ A sample describe an example for this database.
       
@@ -36,6 +188,15 @@ class Sample(Base):
   ----------
   id: str
     The id for the sample
+  modalities: int
+    The bitmask of the modalities having an image (see
+    :py:data:`MODALITY_BITS`), computed when creating the database
+  subject: str
+    The subject of the sample (only known for the training set)
+  video: str
+    The video the frame of the sample comes from
+  frame: int
+    The index of the frame in the video
   
   """
   
@@ -43,11 +204,15 @@ class Sample(Base):
   id = Column(String(100), primary_key=True)
   group_choices = ('train', 'validation', 'test')
   group = Column(Enum(*group_choices))
-  attack_type = Column(Integer)
+  attack_type = Column(Integer, index=True)
+  modalities = Column(Integer, index=True)
+  subject = Column(String(100), index=True)
+  video = Column(String(100), index=True)
+  frame = Column(Integer)
   
   files = relationship("ImageFile", secondary=sample_file_association, backref=backref("Sample", order_by=id))
 
-  def __init__(self, id, group, attack_type=0):
+  def __init__(self, id, group, attack_type=0, subject=None, video=None, frame=None):
     """ Init function
     
     Parameters
@@ -58,13 +223,22 @@ class Sample(Base):
       The group this client belongs to (either 'train', 'validation' or 'test')
     attack_type: int
       The type of attack. Note that 0 corresponds to a real attempt.
+    subject: str
+      The subject of the sample, if known
+    video: str
+      The video the frame of the sample comes from
+    frame: int
+      The index of the frame in the video
     """
     self.id = id
     self.group = group
     self.attack_type = attack_type
+    self.subject = subject
+    self.video = video
+    self.frame = frame
 
 
-  def load(self, directory=None, extension=".jpg", modality=None):
+  def load(self, directory=None, extension=".jpg", modality=None, size=None, gray=False, preprocessed=False, staging=None, pool=None):
     """
     loads a sample.
 
@@ -80,6 +254,28 @@ class Sample(Base):
     modality: str or list of str 
       'all' for all modalities (default), otherwise the name of the modality or a list of
       modalities to consider. Modalities can be ['color', 'infrared', 'depth']
+    size: tuple
+      If given, the (height, width) the images are resized to. When
+      ``Pillow`` is installed, JPEG images are downscaled while decoding.
+    gray: bool or list of str
+      If ``True``, all images are loaded as grayscale (2D) images. It may
+      also be the list of modalities to load as grayscale, e.g.
+      ``['infrared', 'depth']``.
+    preprocessed: bool or str
+      If set, the precomputed face thumbnails (see
+      :py:mod:`bob.db.casiasurf.thumbnails`) are returned instead of the
+      images, and ``directory``, ``extension`` and ``gray`` are ignored. It
+      may also be the directory of the thumbnail store; if ``True``, the
+      store of the packaged database is used (the methods of
+      :py:class:`bob.db.casiasurf.Database` use the store of their own
+      SQLite file instead).
+    staging: :py:class:`bob.db.casiasurf.staging.StagingCache`
+      If given, the images are read from their copy on local scratch. By
+      default, the cache of the database whose original directory is
+      ``directory`` is used, if any (see :py:attr:`bob.db.casiasurf.Database.staging`).
+    pool: :py:class:`bob.db.casiasurf.pool.EncodedPool`
+      If given, the images held in this pool are decoded from memory
+      (see :py:meth:`bob.db.casiasurf.Database.load_pool`)
 
     Returns
     -------
@@ -92,26 +288,76 @@ class Sample(Base):
     mod_to_path['depth'] = 'depth'
 
     retval = {}
-    mods = []
-    if isinstance(modality, str) and modality != 'all':
-      mods = [modality]
-    elif isinstance(modality, str) and modality == 'all':
-      mods = ['color', 'infrared', 'depth']
-    else:
-      for m in modality:
-        mods.append(m)
+    mods = modality_list(modality)
+
+    if staging is None and directory is not None:
+      from . import staging as _staging
+      staging = _staging.lookup(directory)
+
+    if preprocessed:
+      from .thumbnails import open_store
+      store = open_store(None if preprocessed is True else preprocessed)
+
+    from .metrics import registry as metrics
+
+    with metrics.timer('load.sample'):
+      for mod in mods:
+        for f in self.files:
+          if mod_to_path[mod] in f.path and preprocessed:
+            metrics.incr('load.thumbnails')
+            retval[mod] = store.get(f.id, mod)
+            if size is not None and retval[mod].shape[-2:] != tuple(size):
+              retval[mod] = resize_image(retval[mod], size)
+          elif mod_to_path[mod] in f.path:
+            to_gray = gray is True or (not isinstance(gray, bool) and mod in gray)
+            if pool is not None and f.id in pool:
+              metrics.incr('load.pool_hits')
+              buffer = pool.get(f.id)
+              metrics.incr('load.pool_bytes', len(buffer))
+              with metrics.timer('load.decode.%s' % mod):
+                retval[mod] = decode_image(buffer, size, to_gray)
+              continue
+            filename = f.make_path(directory, extension)
+            if staging is not None:
+              with metrics.timer('load.staging'):
+                filename = staging.fetch(filename, f.file_size, f.checksum)
+            with metrics.timer('load.read'):
+              with open(filename, 'rb') as image_file:
+                buffer = image_file.read()
+            metrics.incr('load.bytes_read', len(buffer))
+            with metrics.timer('load.decode.%s' % mod):
+              try:
+                retval[mod] = decode_image(buffer, size, to_gray)
+              except IOError:
+                # not an image format known to Pillow
+                retval[mod] = load_image(filename, size, to_gray)
+      metrics.incr('load.samples')
+      metrics.incr('load.images', len(retval))
 
-    for mod in mods:
-      for f in self.files:
-        if mod_to_path[mod] in f.path:
-          retval[mod] = bob.io.base.load(f.make_path(directory, extension))
-   
     return retval
 
 
   def is_attack(self):
     return self.attack_type != 0
 
+  def is_complete(self, modality='all'):
+    """Returns whether the sample has an image for each of the given modalities"""
+    mask = modality_mask(modality_list(modality))
+    return (self.modalities or 0) & mask == mask
+
+  def _payload(self):
+    """Returns the compact description of the sample, see :py:func:`_rebuild_sample`"""
+    files = [f._payload() for f in self.files]
+    return (self.id, self.group, self.attack_type, files, self.subject, self.video, self.frame)
+
+  def __reduce__(self):
+    """Pickles the sample as its id and the description of its files only
+
+    No session state is carried along: the unpickled sample is detached
+    from any session, and holds transient :py:class:`ImageFile` objects.
+    """
+    return (_rebuild_sample, self._payload())
+
   def __lt__(self, other):
     if self.id < other.id:
       return True
@@ -132,6 +378,16 @@ class ImageFile(Base, bob.db.base.File):
     The modality from which this file was recorded
   path: str
     The path on the disk where this file is stored.
+  width: int
+    The width of the image
+  height: int
+    The height of the image
+  channels: int
+    The number of channels of the image
+  file_size: int
+    The size of the file, in bytes
+  checksum: str
+    The checksum of the contents of the file, if computed
   """
   
   __tablename__ = 'imagefile'
@@ -150,6 +406,15 @@ class ImageFile(Base, bob.db.base.File):
   modality_choices = ('color', 'infrared', 'depth')
   modality = Column(Enum(*modality_choices))
 
+  # dimensions of the image and size of the file, read when creating the database
+  width = Column(Integer)
+  height = Column(Integer)
+  channels = Column(Integer)
+  file_size = Column(Integer)
+
+  # checksum of the contents of the file, see bob.db.casiasurf.checksum
+  checksum = Column(String(32))
+
 
   def __init__(self, sample_id, path, modality):
     """ Init function
@@ -172,6 +437,41 @@ class ImageFile(Base, bob.db.base.File):
   def __repr__(self):
     return "File('%s')" % self.path
 
+  def image_shape(self, size=None, gray=False):
+    """Returns the shape of the loaded image, without reading the file
+
+    Parameters
+    ----------
+    size: tuple
+      The (height, width) the image is resized to, if any
+    gray: bool
+      Whether the image is loaded as grayscale
+
+    Returns
+    -------
+    tuple:
+      The shape of the image, in Bob's format, or ``None`` if the
+      dimensions of the image are not known
+    """
+    if size is None:
+      if self.height is None:
+        return None
+      size = (self.height, self.width)
+    if gray or self.channels == 1:
+      return tuple(size)
+    if self.channels is None:
+      return None
+    return (self.channels,) + tuple(size)
+
+  def _payload(self):
+    """Returns the compact description of the file, see :py:func:`_rebuild_file`"""
+    return (self.id, self.path, self.modality, self.file_size, self.width, self.height, self.channels, self.checksum)
+
+  def __reduce__(self):
+    """Pickles the file as its id, sample id, path, modality and header information only"""
+    payload = self._payload()
+    return (_rebuild_file, (payload[0], self.sample_id) + payload[1:])
+
 
   def make_path(self, directory=None, extension=None):
     """Wraps the current path so that a complete path is formed
@@ -197,6 +497,106 @@ class ImageFile(Base, bob.db.base.File):
     return str(os.path.join(directory, self.path + extension))
 
 
+class Annotation(Base):
+  """Face annotations of an image file
+
+  Annotations are read from the annotation files when the database is
+  created, so that they can be retrieved in bulk.
+
+  Attributes
+  ----------
+  file_id: int
+    The id of the annotated :py:class:`ImageFile`
+  topleft: tuple
+    The (y, x) coordinates of the top-left corner of the face
+  bottomright: tuple
+    The (y, x) coordinates of the bottom-right corner of the face
+  """
+
+  __tablename__ = 'annotation'
+
+  file_id = Column(Integer, ForeignKey('imagefile.id'), primary_key=True)
+  file = relationship(ImageFile, backref=backref('annotation', uselist=False))
+
+  topleft_y = Column(Float)
+  topleft_x = Column(Float)
+  bottomright_y = Column(Float)
+  bottomright_x = Column(Float)
+
+  def __init__(self, file_id, topleft, bottomright):
+    """ Init function
+
+    Parameters
+    ----------
+    file_id: int
+      The id of the annotated file
+    topleft: tuple
+      The (y, x) coordinates of the top-left corner of the face
+    bottomright: tuple
+      The (y, x) coordinates of the bottom-right corner of the face
+    
+    """
+    self.file_id = file_id
+    self.topleft_y, self.topleft_x = topleft
+    self.bottomright_y, self.bottomright_x = bottomright
+
+  @property
+  def topleft(self):
+    return (self.topleft_y, self.topleft_x)
+
+  @property
+  def bottomright(self):
+    return (self.bottomright_y, self.bottomright_x)
+
+  def as_dict(self):
+    """Returns the annotations as a dictionary, as in :py:mod:`bob.db.base`"""
+    return {'topleft': self.topleft, 'bottomright': self.bottomright}
+
+  def __repr__(self):
+    return "Annotation(%d, %s, %s)" % (self.file_id, self.topleft, self.bottomright)
+
+
+def _rebuild_file(id, sample_id, path, modality, file_size=None, width=None, height=None, channels=None, checksum=None):
+  """Re-creates a transient :py:class:`ImageFile` (used when unpickling)"""
+  f = ImageFile(sample_id, path, modality)
+  f.id = id
+  f.file_size = file_size
+  f.width = width
+  f.height = height
+  f.channels = channels
+  f.checksum = checksum
+  return f
+
+
+def _rebuild_sample(id, group, attack_type, files, subject=None, video=None, frame=None):
+  """Re-creates a transient :py:class:`Sample` (used when unpickling)
+
+  Parameters
+  ----------
+  id: str
+    The id of the sample
+  group: str
+    The group of the sample
+  attack_type: int
+    The type of attack (0 for a real attempt)
+  files: list of tuple
+    The ``(id, path, modality)`` of each file of the sample, optionally
+    followed by its size, width, height, number of channels and checksum
+  subject: str
+    The subject of the sample
+  video: str
+    The video of the sample
+  frame: int
+    The index of the frame in the video
+
+  """
+  sample = Sample(id, group, attack_type, subject, video, frame)
+  for f in files:
+    sample.files.append(_rebuild_file(f[0], id, *f[1:]))
+  sample.modalities = modality_mask(set(f[2] for f in files))
+  return sample
+
+
 class Protocol(Base):
   """CASIA-SURF protocols
  
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""RAM-resident pool of encoded image files
+
+The encoded (JPEG) files of a selection are read once into a single
+contiguous buffer, along with the offset of each file. Images are then
+decoded from memory views on this buffer, without any filesystem access.
+"""
+
+import os
+
+import numpy
+
+import bob.core
+logger = bob.core.log.setup('bob.db.casiasurf')
+
+
+class EncodedPool(object):
+  """Encoded files held in a single contiguous buffer
+
+  Parameters
+  ----------
+  buffer: :py:class:`numpy.ndarray`
+    The (uint8) buffer with the contents of all files
+  index: dict
+    The id of each file as key, and its ``(offset, length)`` in the buffer
+    as value
+  """
+
+  def __init__(self, buffer, index):
+    self.buffer = buffer
+    self.index = index
+
+  @classmethod
+  def read(cls, files, jobs=4):
+    """Reads files into a new pool
+
+    Parameters
+    ----------
+    files: list of tuple
+      The (id, path, size) of the files; the size may be ``None`` if unknown
+    jobs: int
+      The number of parallel threads reading the files
+
+    Returns
+    -------
+    :py:class:`EncodedPool`:
+      The pool holding the files
+    """
+    from multiprocessing.pool import ThreadPool
+
+    sizes = [size if size is not None else os.path.getsize(path) for _, path, size in files]
+    offsets = numpy.concatenate(([0], numpy.cumsum(sizes, dtype=numpy.int64)))
+    buffer = numpy.empty(int(offsets[-1]), dtype=numpy.uint8)
+    view = memoryview(buffer)
+
+    def read_into(k):
+      start, end = int(offsets[k]), int(offsets[k + 1])
+      with open(files[k][1], 'rb') as f:
+        if f.readinto(view[start:end]) != end - start:
+          raise IOError("File %s does not have the expected size of %d bytes" % (files[k][1], end - start))
+
+    pool = ThreadPool(jobs)
+    try:
+      pool.map(read_into, range(len(files)), chunksize=64)
+    finally:
+      pool.close()
+      pool.join()
+
+    index = dict((f[0], (int(offsets[k]), sizes[k])) for k, f in enumerate(files))
+    logger.info("Read {} files ({} bytes) into memory".format(len(files), buffer.nbytes))
+    return cls(buffer, index)
+
+  @property
+  def nbytes(self):
+    return self.buffer.nbytes
+
+  def __len__(self):
+    return len(self.index)
+
+  def __contains__(self, file_id):
+    return file_id in self.index
+
+  def get(self, file_id):
+    """Returns a memory view on the contents of a file"""
+    offset, length = self.index[file_id]
+    return memoryview(self.buffer)[offset:offset + length]
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Background prefetching of image files
+
+Files are read (to warm the page cache) or copied to local scratch (see
+:py:mod:`bob.db.casiasurf.staging`) by a pool of threads, with an optional
+limit on the total bandwidth.
+"""
+
+import time
+import threading
+
+import bob.core
+logger = bob.core.log.setup('bob.db.casiasurf')
+
+
+class _Throttle(object):
+  """Limits the rate at which bytes are read by several threads"""
+
+  def __init__(self, rate):
+    self.rate = float(rate)
+    self.next = time.time()
+    self.lock = threading.Lock()
+
+  def consume(self, n):
+    with self.lock:
+      now = time.time()
+      start = max(now, self.next)
+      self.next = start + n / self.rate
+    if start > now:
+      time.sleep(start - now)
+
+
+def _read(filename, throttle, chunk_size=1024 * 1024):
+  """Reads a file, so that it ends up in the page cache"""
+  n_bytes = 0
+  with open(filename, 'rb') as f:
+    while True:
+      chunk = f.read(chunk_size)
+      if not chunk:
+        break
+      n_bytes += len(chunk)
+      # only the bytes actually read are charged
+      if throttle is not None:
+        throttle.consume(len(chunk))
+  return n_bytes
+
+
+def prefetch_files(files, staging=None, jobs=4, max_bandwidth=None, callback=None):
+  """Reads, or copies to local scratch, a list of files in parallel
+
+  Parameters
+  ----------
+  files: list of tuple
+    The (path, size) of the files; the size may be ``None`` if unknown
+  staging: :py:class:`bob.db.casiasurf.staging.StagingCache`
+    If given, the files are copied to local scratch; otherwise they are
+    only read
+  jobs: int
+    The number of parallel threads
+  max_bandwidth: float
+    The maximum number of bytes read per second, over all threads
+  callback: callable
+    If given, called after each file with the number of files and bytes
+    prefetched so far, and the total number of files
+
+  Returns
+  -------
+  tuple:
+    The number of files and of bytes prefetched
+  """
+  from multiprocessing.pool import ThreadPool
+
+  throttle = _Throttle(max_bandwidth) if max_bandwidth else None
+
+  def fetch(f):
+    path, size = f
+    if staging is None:
+      return _read(path, throttle)
+    # only the bytes actually copied (not the hits) are charged
+    staging.fetch(path, size, on_read=throttle.consume if throttle is not None else None)
+    return size if size is not None else 0
+
+  n_files = 0
+  n_bytes = 0
+  pool = ThreadPool(jobs)
+  try:
+    for size in pool.imap_unordered(fetch, files, chunksize=16):
+      n_files += 1
+      n_bytes += size
+      if callback is not None:
+        callback(n_files, n_bytes, len(files))
+  finally:
+    pool.close()
+    pool.join()
+
+  logger.info("Prefetched {} files ({} bytes)".format(n_files, n_bytes))
+  return n_files, n_bytes
@@ -2,6 +2,7 @@
 # encoding: utf-8
 
 import os
+import numbers
 from bob.db.base import utils
 from .models import *
 
@@ -11,6 +12,53 @@ SQLITE_FILE = INFO.files()[0]
 
 import bob.db.base
 
+# columns of the metadata tables, see Database.to_table()
+METADATA_COLUMNS = ('sample_id', 'file_id', 'group', 'attack_type', 'label', 'modality', 'path')
+
+# size of the memory-mapped page cache used by read-only connections
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+def _session_immutable(dbfile, mmap_size=MMAP_SIZE, echo=False):
+  """Creates a session on an immutable, read-only SQLite file
+
+  The file is opened as an URI with ``mode=ro`` and ``immutable=1``, so that
+  SQLite does not take any lock on it, and the pages are served from a
+  memory-mapped cache. This is only safe as long as nobody writes to the file.
+
+  Parameters
+  ----------
+  dbfile: str
+    The path to the SQLite file
+  mmap_size: int
+    The size (in bytes) of the memory-mapped page cache
+  echo: bool
+    Whether to echo the SQL statements
+
+  Returns
+  -------
+  :py:class:`sqlalchemy.orm.Session`:
+    The read-only session
+  """
+  import sqlite3
+  from urllib.request import pathname2url
+  from sqlalchemy import create_engine
+  from sqlalchemy.orm import sessionmaker
+  from sqlalchemy.pool import SingletonThreadPool
+
+  uri = 'file:%s?mode=ro&immutable=1' % pathname2url(os.path.abspath(dbfile))
+
+  def creator():
+    connection = sqlite3.connect(uri, uri=True)
+    connection.execute('PRAGMA mmap_size = %d' % mmap_size)
+    connection.execute('PRAGMA query_only = 1')
+    return connection
+
+  engine = create_engine('sqlite://', creator=creator, poolclass=SingletonThreadPool, echo=echo)
+  Session = sessionmaker(bind=engine)
+  return Session()
+
+
 class Database(bob.db.base.SQLiteDatabase):
   """ Class representing the database
 
@@ -26,6 +74,14 @@ class Database(bob.db.base.SQLiteDatabase):
     Path where the annotations are stored
   annotation_extension: str
     Extension of anootation files
+  read_only: bool
+    Whether the SQLite file is opened as an immutable, read-only file
+  query_cache: str
+    The query cache in use, if any ('memory' or 'disk')
+  staging: :py:class:`bob.db.casiasurf.staging.StagingCache`
+    The local-scratch copies of the image files, if any
+  pool: :py:class:`bob.db.casiasurf.pool.EncodedPool`
+    The encoded image files held in memory, if any (see :py:meth:`load_pool`)
 
   """
 
@@ -34,7 +90,14 @@ class Database(bob.db.base.SQLiteDatabase):
                original_extension=None,
                annotation_directory=None,
                annotation_extension=None,
-               protocol='all'):
+               protocol='all',
+               read_only=False,
+               mmap_size=MMAP_SIZE,
+               query_cache=None,
+               query_cache_directory=None,
+               scratch_directory=None,
+               scratch_size=None,
+               sqlite_file=None):
     """ Init function
 
     Parameters
@@ -47,12 +110,154 @@ class Database(bob.db.base.SQLiteDatabase):
       Path where the annotations are stored
     annotation_extension: str
       Extension of annotation files
+    protocol: str
+      The default protocol
+    read_only: bool
+      If set, the SQLite file is opened as an immutable, read-only URI
+      with a memory-mapped page cache. No lock is ever taken, which makes
+      it safe to have many concurrent reader processes, but the file
+      must not be modified while it is opened.
+    mmap_size: int
+      The size (in bytes) of the memory-mapped page cache (read-only mode)
+    query_cache: str
+      If 'memory', the results of :py:meth:`objects` are memoised in the
+      current process. If 'disk', they are also persisted on disk, and
+      shared with other processes. Samples returned from the cache are
+      detached from the session, see :py:func:`bob.db.casiasurf.models._rebuild_sample`.
+    query_cache_directory: str
+      The directory of the on-disk query cache. By default, it is next to
+      the SQLite file.
+    scratch_directory: str
+      If given, image files are copied to this (local) directory the first
+      time they are loaded, and are then read from there. Copies are checked
+      against the sizes and checksums stored in the database. The samples
+      loaded from ``original_directory`` use the copies transparently.
+    scratch_size: int
+      The maximum size (in bytes) of the copies on scratch; the least
+      recently used ones are evicted first.
+    sqlite_file: str
+      The SQLite file of the database. By default, the one created by
+      ``bob_dbmanage.py casiasurf create``.
 
     """
-    super(Database, self).__init__(SQLITE_FILE, ImageFile, original_directory, original_extension)
+    super(Database, self).__init__(sqlite_file or SQLITE_FILE, ImageFile, original_directory, original_extension)
     self.annotation_directory = annotation_directory
     self.annotation_extension = annotation_extension
     self.protocol = protocol
+    self.read_only = read_only
+    self.mmap_size = mmap_size
+    self.query_cache = query_cache
+    self.query_cache_directory = query_cache_directory
+    self.scratch_directory = scratch_directory
+    self.scratch_size = scratch_size
+    self.pool = None
+    self.staging = None
+    if scratch_directory is not None:
+      from .staging import StagingCache, register
+      self.staging = StagingCache(scratch_directory, scratch_size)
+      if original_directory is not None:
+        # samples of this database are then transparently read from scratch
+        register(original_directory, self.staging)
+    self._pid = os.getpid()
+    self._query_cache = None
+    self._protocols = None
+    if self.read_only:
+      self._connect()
+
+  def __getstate__(self):
+    """Pickles the database as its constructor arguments only
+
+    The session is not pickled: the unpickled database creates its own
+    one, which only connects to the SQLite file on the first query.
+    """
+    return dict(
+      original_directory=self.original_directory,
+      original_extension=self.original_extension,
+      annotation_directory=self.annotation_directory,
+      annotation_extension=self.annotation_extension,
+      protocol=self.protocol,
+      read_only=self.read_only,
+      mmap_size=self.mmap_size,
+      query_cache=self.query_cache,
+      query_cache_directory=self.query_cache_directory,
+      scratch_directory=self.scratch_directory,
+      scratch_size=self.scratch_size,
+      sqlite_file=self.m_sqlite_file,
+    )
+
+  def __setstate__(self, state):
+    self.__init__(**state)
+
+  def _connect(self):
+    """(Re-)creates the session to the SQLite file for the current process"""
+    if self.m_session is not None:
+      self.m_session.close()
+    if not os.path.exists(self.m_sqlite_file):
+      self.m_session = None
+    elif self.read_only:
+      self.m_session = _session_immutable(self.m_sqlite_file, self.mmap_size)
+    else:
+      self.m_session = utils.session_try_readonly('sqlite', self.m_sqlite_file)
+    self._pid = os.getpid()
+    self._protocols = None
+
+  def _get_query_cache(self):
+    """Returns the query cache, created on first use
+
+    If the SQLite file changed (e.g. it was re-created) since the cache was
+    created, the session is re-created, as well as the cache.
+    """
+    if self._query_cache is not None and self._query_cache.stale():
+      logger.info("{} changed, reconnecting".format(self.m_sqlite_file))
+      self._connect()
+      self._query_cache = None
+    if self._query_cache is None:
+      from sqlalchemy import text
+      from .cache import QueryCache, default_directory
+      schema_version = self.query(Sample.id).session.execute(text('PRAGMA user_version')).scalar()
+      directory = None
+      if self.query_cache == 'disk':
+        directory = self.query_cache_directory or default_directory(self.m_sqlite_file)
+      self._query_cache = QueryCache(self.m_sqlite_file, schema_version, directory)
+    return self._query_cache
+
+  def query(self, *args):
+    """Creates a query on the underlying session
+
+    If the process was forked since the session has been created, the
+    session is first re-created: connections must not be shared across
+    processes.
+    """
+    if self._pid != os.getpid():
+      # do not close the inherited session, it belongs to the parent
+      self.m_session = None
+      self._connect()
+    return super(Database, self).query(*args)
+
+  def metrics(self, reset=False):
+    """Returns the counters and latencies recorded in the current process
+
+    Queries (:py:meth:`objects`, :py:meth:`iter_objects`) and the loading of
+    the samples record, in a registry shared by all databases of the
+    process, their latency, the number of rows returned, the bytes read,
+    the decoding time of each modality and the hits of the caches. Hooks
+    exporting the metrics as they are recorded are added with
+    :py:func:`bob.db.casiasurf.metrics.add_hook`.
+
+    Parameters
+    ----------
+    reset: bool
+      If set, the metrics are reset after being returned
+
+    Returns
+    -------
+    dict:
+      The ``counters`` and the ``latencies`` (count, sum, min, max, mean
+      and percentiles, in seconds), by name, see
+      :py:meth:`bob.db.casiasurf.metrics.Metrics.snapshot`
+    """
+    from .metrics import registry
+    return registry.snapshot(reset)
 
   def groups(self, protocol=None):     
     """Returns the names of all registered groups
@@ -73,7 +278,51 @@ class Database(bob.db.base.SQLiteDatabase):
     return ProtocolPurpose.purpose_choices
 
 
-  def objects(self, purposes=None, groups=None):
+  def protocols(self):
+    """Returns the names of all registered protocols
+
+    The names are queried once per session, since they are validated on
+    each query (including the ones served from the query cache).
+    """
+    if self._protocols is None or self._pid != os.getpid():
+      self._protocols = [p.name for p in self.query(Protocol).order_by(Protocol.id)]
+    return list(self._protocols)
+
+
+  def subjects(self, purposes=None, groups=None, protocol=None, counts=False):
+    """Returns the subjects of the selected samples
+
+    Subjects are only known for the training set: samples of the
+    validation and test sets are anonymised. Parameters are the same as
+    for :py:meth:`objects`.
+
+    Parameters
+    ----------
+    counts: bool
+      If set, the number of samples and videos of each subject are also
+      returned
+
+    Returns
+    -------
+    list or dict:
+      The sorted list of subjects or, if ``counts`` is set, a dictionary
+      with the subject as key and the ``(number of samples, number of
+      videos)`` as value.
+    """
+    from sqlalchemy import func
+    filters = self._check_filters(protocol, purposes, groups)
+    q = self._objects_query(**filters)\
+            .filter(Sample.subject.isnot(None))\
+            .with_entities(Sample.subject, func.count(Sample.id), func.count(Sample.video.distinct()))\
+            .group_by(Sample.subject)\
+            .order_by(None)\
+            .order_by(Sample.subject)
+    if counts:
+      return dict((subject, (n_samples, n_videos)) for subject, n_samples, n_videos in q)
+    return [subject for subject, _, _ in q]
+
+
+  def objects(self, purposes=None, groups=None, protocol=None, shard_index=0, num_shards=1, complete=False, subjects=None, attack_types=None):
     """Returns a set of Samples for the specific query by the user.
     
     Note that a sample may contain up to 3 modalities (color, infrared and depth)
@@ -89,22 +338,761 @@ class Database(bob.db.base.SQLiteDatabase):
       One of the groups ('dev', 'eval', 'train') or a tuple with several of them.
       If 'None' is given (this is the default), it is considered the same as a
       tuple with all possible values.
+    protocol: str
+      The protocol to consider. If 'None' is given (this is the default),
+      the protocol given to the constructor is used.
+    shard_index: int
+      The index of the shard to retrieve, between 0 and ``num_shards - 1``.
+    num_shards: int
+      The number of shards the selected samples are split into. Samples are
+      assigned to shards in SQL, by their rank in the id ordering modulo
+      ``num_shards``: shards are disjoint, deterministic and balanced.
+    complete: bool
+      If set, only the samples having an image for each modality of the
+      protocol are returned.
+    subjects: str or tuple
+      If given, only the samples of this subject, or of these subjects, are
+      returned (see :py:meth:`subjects`).
+    attack_types: int or tuple
+      If given, only the samples of this attack type, or of these attack
+      types, are returned (0 being real accesses).
 
     Returns
     -------
     list:
-      A list of samples which have the given properties.
+      A list of samples which have the given properties, sorted by id.
     
     """
-    from sqlalchemy import and_
+    from .metrics import registry as metrics
+    cache = self._get_query_cache() if self.query_cache is not None else None
+    filters = self._check_filters(protocol, purposes, groups, shard_index, num_shards, complete, subjects, attack_types)
+
+    if cache is None:
+      with metrics.timer('objects.query'):
+        retval = list(self._objects_query(**filters))
+      metrics.incr('objects.rows', len(retval))
+      return retval
+
+    from .models import _rebuild_sample
+    key = cache.key(**filters)
+    entries = cache.get(key)
+    if entries is not None:
+      metrics.incr('objects.cache_hits')
+      metrics.incr('objects.rows', len(entries))
+      return [_rebuild_sample(*e) for e in entries]
+
+    from sqlalchemy.orm import selectinload
+    metrics.incr('objects.cache_misses')
+    with metrics.timer('objects.query'):
+      retval = list(self._objects_query(**filters).options(selectinload(Sample.files)))
+    metrics.incr('objects.rows', len(retval))
+    cache.set(key, [s._payload() for s in retval])
+    return retval
+
+
+  def count_objects(self, purposes=None, groups=None, protocol=None, shard_index=0, num_shards=1, complete=False, subjects=None, attack_types=None):
+    """Returns the number of Samples for the specific query by the user.
+
+    The samples are counted in SQL, without being retrieved. Parameters
+    are the same as for :py:meth:`objects`.
+
+    Returns
+    -------
+    int:
+      The number of samples which have the given properties
+    """
+    from sqlalchemy import func
+    filters = self._check_filters(protocol, purposes, groups, shard_index, num_shards, complete, subjects, attack_types)
+    return self._objects_query(**filters).order_by(None).with_entities(func.count(Sample.id)).scalar()
+
+
+  def iter_objects(self, purposes=None, groups=None, protocol=None, shard_index=0, num_shards=1, complete=False, subjects=None, attack_types=None, chunk_size=1000):
+    """Iterates over the Samples for the specific query by the user.
+
+    Contrary to :py:meth:`objects`, samples are fetched by chunks (with their
+    files), so that the whole list is never held in memory. Parameters are
+    the same as for :py:meth:`objects`.
+
+    Parameters
+    ----------
+    chunk_size: int
+      The number of samples fetched by each SQL query
+
+    Returns
+    -------
+    :py:class:`bob.db.casiasurf.iterator.SampleIterator`:
+      An iterator over the samples which have the given properties, sorted
+      by id. Its :py:meth:`bob.db.casiasurf.iterator.SampleIterator.cursor`
+      can be saved to resume the iteration later, see :py:meth:`resume`.
+
+    """
+    from .iterator import SampleIterator
+    filters = self._check_filters(protocol, purposes, groups, shard_index, num_shards, complete, subjects, attack_types)
+    return SampleIterator(self, filters, chunk_size)
+
+
+  def resume(self, cursor, chunk_size=1000):
+    """Resumes an iteration from its cursor
+
+    The iteration restarts just after the last sample described by the
+    cursor, without re-scanning the samples processed before.
+
+    Parameters
+    ----------
+    cursor: dict
+      The cursor of an iterator returned by :py:meth:`iter_objects`
+    chunk_size: int
+      The number of samples fetched by each SQL query
+
+    Returns
+    -------
+    :py:class:`bob.db.casiasurf.iterator.SampleIterator`:
+      The iterator over the remaining samples
+    """
+    from .iterator import SampleIterator, CURSOR_VERSION
+    if cursor.get('version') != CURSOR_VERSION:
+      raise ValueError("Cursor version %s is not supported (expected %d)" % (cursor.get('version'), CURSOR_VERSION))
+    return SampleIterator(self, cursor['filters'], chunk_size, cursor['last'], cursor['position'])
+
+
+  def sample_ids_by_attack_type(self, purposes=None, groups=None, protocol=None):
+    """Indexes the ids of the selected samples by attack type
+
+    Parameters are the same as for :py:meth:`objects`.
+
+    Returns
+    -------
+    dict:
+      The attack type (0 for real samples) as key and the sorted array of
+      the corresponding sample ids as value.
+    """
+    import numpy
+    filters = self._check_filters(protocol, purposes, groups, 0, 1)
+    q = self._objects_query(**filters).with_entities(Sample.id, Sample.attack_type)
+
+    index = {}
+    for sample_id, attack_type in q:
+      index.setdefault(attack_type, []).append(sample_id)
+    return dict((k, numpy.array(v, dtype=object)) for k, v in index.items())
+
+
+  def annotations(self, samples, modality=None, as_array=False, chunk_size=500):
+    """Returns the face annotations of samples, in bulk
+
+    Annotations are stored in the database by ``create`` (see its
+    ``--annotations-dir`` option), and are retrieved with a few queries,
+    whatever the number of samples.
+
+    Parameters
+    ----------
+    samples: list
+      The samples (or sample ids) to get the annotations of
+    modality: str
+      If given, only the annotations of this modality are returned
+    as_array: bool
+      If set, the annotations of the given modality are returned as an
+      array of shape (len(samples), 4), each row being the
+      ``(top, left, bottom, right)`` coordinates of the face, or ``NaN``
+      for samples that are not annotated.
+    chunk_size: int
+      The number of samples handled by each SQL query
+
+    Returns
+    -------
+    dict or :py:class:`numpy.ndarray`:
+      The sample id as key, and a dictionary with the modality as key and
+      the annotations (see :py:meth:`bob.db.casiasurf.models.Annotation.as_dict`)
+      as value. Or the array of annotations, if ``as_array`` is set.
+    """
+    if as_array and modality is None:
+      raise ValueError("A modality must be given to get annotations as an array")
+
+    ids = [s.id if isinstance(s, Sample) else s for s in samples]
+    unique = list(set(ids))
+    retval = {}
+    for i in range(0, len(unique), chunk_size):
+      q = self.query(ImageFile.sample_id, ImageFile.modality, Annotation)\
+              .join((Annotation, Annotation.file_id == ImageFile.id))\
+              .filter(ImageFile.sample_id.in_(unique[i:i + chunk_size]))
+      if modality is not None:
+        q = q.filter(ImageFile.modality == modality)
+      for sample_id, mod, annotation in q:
+        retval.setdefault(sample_id, {})[mod] = annotation.as_dict()
+
+    if not as_array:
+      return retval
+
+    import numpy
+    array = numpy.full((len(ids), 4), numpy.nan)
+    for k, sample_id in enumerate(ids):
+      if sample_id in retval:
+        a = retval[sample_id][modality]
+        array[k] = a['topleft'] + a['bottomright']
+    return array
+
+
+  def load_batches(self, batches, directory=None, extension=None, modality='all', size=None, gray=False, preprocessed=False, stack=False, locality=None):
+    """Loads batches of samples
+
+    Parameters
+    ----------
+    batches: iterable
+      The batches to load, each being a list of samples or of sample ids,
+      for instance drawn by a :py:class:`bob.db.casiasurf.BatchSampler`
+    directory: str
+      The directory of the database. By default, the original directory.
+    extension: str
+      The extension of the image files. By default, the original extension.
+    modality: str or list of str
+      The modality(ies) to load, see :py:meth:`bob.db.casiasurf.models.Sample.load`
+    size: tuple
+      The (height, width) images are resized to, see :py:meth:`bob.db.casiasurf.models.Sample.load`
+    gray: bool or list of str
+      The modalities loaded as grayscale, see :py:meth:`bob.db.casiasurf.models.Sample.load`
+    preprocessed: bool or str
+      Whether to load the precomputed thumbnails, see :py:meth:`bob.db.casiasurf.models.Sample.load`.
+      If ``True``, the store next to the SQLite file of this database is used.
+    stack: bool
+      If set, the images of each modality are stacked into a single array
+      of shape (batch size, ...), allocated up front from the dimensions
+      stored in the database. All the images of a modality must then have
+      the same dimensions (e.g. when ``size`` is given, or when the samples
+      are grouped with :py:meth:`group_by_shape`).
+    locality: str
+      If given, the samples of a batch are read in the order of their
+      location on disk, by 'path' (i.e. by directory) or by 'inode', to
+      help read-ahead. They are still returned in the order of the batch.
+
+    Yields
+    ------
+    tuple:
+      The list of samples in the batch, and the list of their loaded data
+      (or, if ``stack`` is set, a dictionary with the modality as key and
+      the stacked images as value)
+    """
+    directory = directory or self.original_directory
+    extension = extension or self.original_extension or '.jpg'
+    preprocessed = self._thumbnails_directory(preprocessed)
+    for batch in batches:
+      ids = [s for s in batch if not isinstance(s, Sample)]
+      resolved = iter(self.get_samples(ids))
+      samples = [s if isinstance(s, Sample) else next(resolved) for s in batch]
+      order = self._read_order(samples, directory, extension, locality)
+      if stack:
+        yield samples, self._load_stacked(samples, order, directory, extension, modality, size, gray, preprocessed)
+      else:
+        data = [None] * len(samples)
+        for k in order:
+          data[k] = samples[k].load(directory, extension, modality, size, gray, preprocessed, self.staging, self.pool)
+        yield samples, data
+
+
+  def load_stream(self, samples, window=256, directory=None, extension=None, modality='all', size=None, gray=False, preprocessed=False, locality=None):
+    """Loads a stream of samples
+
+    Samples are read by windows (for instance, in the order of their
+    location on disk), but are yielded one by one in the order of the
+    stream. Parameters are the same as for :py:meth:`load_batches`.
+
+    Parameters
+    ----------
+    samples: iterable
+      The samples (or sample ids) to load, e.g. from :py:meth:`iter_objects`
+    window: int
+      The number of samples read together
+
+    Yields
+    ------
+    tuple:
+      A sample and its loaded data
+    """
+    import itertools
+    samples = iter(samples)
+
+    def windows():
+      while True:
+        w = list(itertools.islice(samples, window))
+        if not w:
+          return
+        yield w
+
+    for batch, data in self.load_batches(windows(), directory, extension, modality, size, gray, preprocessed, locality=locality):
+      for pair in zip(batch, data):
+        yield pair
+
+
+  def _read_order(self, samples, directory, extension, locality):
+    """Returns the order in which the samples should be read"""
+    if locality is None:
+      return range(len(samples))
+    if locality == 'path':
+      keys = [min(f.path for f in s.files) if s.files else '' for s in samples]
+    elif locality == 'inode':
+      keys = []
+      for s in samples:
+        try:
+          keys.append(os.stat(min(s.files, key=lambda f: f.path).make_path(directory, extension)).st_ino)
+        except (OSError, ValueError):
+          keys.append(0)
+    else:
+      raise ValueError("Unknown locality '%s', should be 'path' or 'inode'" % locality)
+    return sorted(range(len(samples)), key=keys.__getitem__)
+
+
+  def _thumbnails_directory(self, preprocessed):
+    """Resolves ``preprocessed=True`` to the thumbnail store of this database"""
+    if preprocessed is True:
+      from .thumbnails import default_directory
+      return default_directory(self.m_sqlite_file)
+    return preprocessed
+
+
+  def _loaded_shape(self, sample, modality, size, gray, preprocessed):
+    """Returns the shape of a loaded image of a sample, without reading it
+
+    The shape is computed from the dimensions stored in the database (or,
+    for thumbnails, from the store), and is ``None`` if they are unknown.
+    """
+    if preprocessed:
+      from .thumbnails import open_store
+      shape = open_store(self._thumbnails_directory(preprocessed)).shape(modality)
+      return tuple(shape[:-2]) + tuple(size) if size is not None else tuple(shape)
+    to_gray = gray is True or (not isinstance(gray, bool) and modality in gray)
+    shapes = [f.image_shape(size, to_gray) for f in sample.files if f.modality == modality]
+    return shapes[0] if shapes else None
+
+
+  def group_by_shape(self, samples, modality='all', size=None, gray=False, preprocessed=False):
+    """Groups samples by the shape of their loaded images
+
+    Shapes are computed from the dimensions stored in the database, without
+    reading any image. Each group can then be loaded as a stacked batch (see
+    :py:meth:`load_batches`), even if the images of the samples do not all
+    have the same dimensions. Parameters are the same as for
+    :py:meth:`load_batches`.
+
+    Parameters
+    ----------
+    samples: list
+      The samples to group
+
+    Returns
+    -------
+    list:
+      The groups of samples (each in the order of the given samples), by
+      decreasing size
+    """
+    preprocessed = self._thumbnails_directory(preprocessed)
+    groups = {}
+    for s in samples:
+      key = tuple(self._loaded_shape(s, mod, size, gray, preprocessed) for mod in modality_list(modality))
+      groups.setdefault(key, []).append(s)
+    return sorted(groups.values(), key=len, reverse=True)
+
+
+  def _load_stacked(self, samples, order, directory, extension, modality, size, gray, preprocessed):
+    """Loads samples (in the given order) into arrays preallocated for each modality
+
+    The arrays are allocated before any image is decoded, from the
+    dimensions stored in the database. Only when these are unknown (e.g. for
+    databases created before they were stored), the array of a modality is
+    allocated from its first decoded image. Arrays are allocated as 8-bit,
+    and reallocated if the first decoded image has another type (e.g. a
+    16-bit PNG).
+    """
+    import numpy
+    mods = modality_list(modality)
+    buffers = {}
+    for mod in mods:
+      shapes = set(self._loaded_shape(s, mod, size, gray, preprocessed) for s in samples)
+      if len(shapes) > 1 and None not in shapes:
+        raise ValueError("Cannot stack %s images of shapes %s; use size, or group the samples with group_by_shape()" % (mod, sorted(shapes)))
+      if len(shapes) == 1 and None not in shapes:
+        # JPEG images (and the thumbnails) are 8-bit
+        buffers[mod] = numpy.empty((len(samples),) + shapes.pop(), dtype=numpy.uint8)
+
+    filled = set()
+    for k in order:
+      s = samples[k]
+      data = s.load(directory, extension, modality, size, gray, preprocessed, self.staging, self.pool)
+      for mod in mods:
+        if mod not in data:
+          raise IOError("Sample '%s' has no %s image" % (s.id, mod))
+        if mod not in buffers:
+          buffers[mod] = numpy.empty((len(samples),) + data[mod].shape, dtype=data[mod].dtype)
+        elif mod not in filled and data[mod].dtype != buffers[mod].dtype:
+          buffers[mod] = numpy.empty(buffers[mod].shape, dtype=data[mod].dtype)
+        if data[mod].shape != buffers[mod].shape[1:]:
+          raise ValueError("Cannot stack the %s image of sample '%s', of shape %s, with images of shape %s" % (mod, s.id, data[mod].shape, buffers[mod].shape[1:]))
+        if data[mod].dtype != buffers[mod].dtype:
+          raise ValueError("Cannot stack the %s image of sample '%s', of type %s, with images of type %s" % (mod, s.id, data[mod].dtype, buffers[mod].dtype))
+        buffers[mod][k] = data[mod]
+        filled.add(mod)
+    return buffers
+
+
+  def get_samples(self, ids, chunk_size=500):
+    """Returns the samples with the given ids
+
+    Ids are resolved by chunks with ``IN`` queries, which also fetch the
+    files of the samples.
+
+    Parameters
+    ----------
+    ids: list of str
+      The ids of the samples
+    chunk_size: int
+      The number of ids resolved by each SQL query (SQLite limits the
+      number of parameters of a query to 999)
+
+    Returns
+    -------
+    list:
+      The samples, in the same order as the given ids
+
+    Raises
+    ------
+    KeyError
+      If some of the ids are not in the database
+    """
+    from sqlalchemy.orm import selectinload
+    unique = list(set(ids))
+    found = {}
+    for i in range(0, len(unique), chunk_size):
+      q = self.query(Sample)\
+              .filter(Sample.id.in_(unique[i:i + chunk_size]))\
+              .options(selectinload(Sample.files))
+      for s in q:
+        found[s.id] = s
+
+    if len(found) != len(unique):
+      missing = [i for i in unique if i not in found]
+      raise KeyError("%d sample id(s) could not be found, e.g. '%s'" % (len(missing), missing[0]))
+    return [found[i] for i in ids]
+
+
+  def stats(self, purposes=None, groups=None, protocol=None, with_bytes=False):
+    """Returns aggregate statistics on the selected samples
+
+    The statistics are computed with a single ``GROUP BY`` query, by group,
+    purpose, attack type and modality. Parameters are the same as for
+    :py:meth:`objects`.
+
+    Parameters
+    ----------
+    with_bytes: bool
+      If set, the total size of the files (as stored by ``create``) is also
+      computed
+
+    Returns
+    -------
+    list:
+      A dictionary for each (group, purpose, attack type, modality), with
+      the number of ``samples`` and ``files`` (and ``bytes``)
+    """
+    from sqlalchemy import func
+    filters = self._check_filters(protocol, purposes, groups)
+    keys = (Sample.group, ProtocolPurpose.purpose, Sample.attack_type, ImageFile.modality)
+    aggregates = [func.count(Sample.id.distinct()), func.count(ImageFile.id)]
+    if with_bytes:
+      aggregates.append(func.sum(ImageFile.file_size))
+
+    q = self._objects_query(**filters)\
+            .outerjoin((ImageFile, ImageFile.sample_id == Sample.id))\
+            .order_by(None)\
+            .with_entities(*(keys + tuple(aggregates)))\
+            .group_by(*keys)\
+            .order_by(*keys)
+
+    names = ('group', 'purpose', 'attack_type', 'modality', 'samples', 'files', 'bytes')
+    return [dict(zip(names, row)) for row in q]
+
+
+  def prefetch(self, protocol=None, groups=None, purposes=None, modality='all', directory=None,
+               extension=None, jobs=4, max_bandwidth=None, callback=None, wait=False):
+    """Prefetches the image files of the selected samples
+
+    The list of files is resolved in SQL, and the files are then read (to
+    warm the page cache) or, if the database has a :py:attr:`staging`
+    cache, copied to local scratch, by a pool of threads.
+
+    Parameters
+    ----------
+    protocol, groups, purposes:
+      The selection of samples, see :py:meth:`objects`
+    modality: str or list of str
+      The modality(ies) to prefetch
+    directory: str
+      The directory of the database. By default, the original directory.
+    extension: str
+      The extension of the image files. By default, the original extension.
+    jobs: int
+      The number of parallel threads
+    max_bandwidth: float
+      The maximum number of bytes read per second
+    callback: callable
+      If given, called after each file with the number of files and bytes
+      prefetched so far, and the total number of files
+    wait: bool
+      If set, returns when all files are prefetched. Otherwise, files are
+      prefetched in a background thread, which is returned.
+
+    Returns
+    -------
+    tuple or :py:class:`threading.Thread`:
+      The number of files and bytes prefetched or, if ``wait`` is not set,
+      the (started) background thread
+    """
+    from .prefetch import prefetch_files
+    directory = directory or self.original_directory or ''
+    extension = extension or self.original_extension or '.jpg'
+    filters = self._check_filters(protocol, purposes, groups)
+    files = [(os.path.join(directory, path + extension), size)
+        for _, path, size in self._files_query(filters, modality)]
+
+    kwargs = dict(staging=self.staging, jobs=jobs, max_bandwidth=max_bandwidth, callback=callback)
+    if wait:
+      return prefetch_files(files, **kwargs)
+
+    import threading
+    thread = threading.Thread(target=prefetch_files, args=(files,), kwargs=kwargs)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+  def load_pool(self, protocol=None, groups=None, purposes=None, modality='all', directory=None, extension=None, jobs=4):
+    """Reads the encoded image files of a selection into memory
+
+    All the files are read into a single contiguous buffer, which is then
+    used by :py:meth:`load_batches` and :py:meth:`load_stream`: images are
+    decoded from memory, without any filesystem access. Decoding from
+    memory requires ``Pillow``.
+
+    Parameters
+    ----------
+    protocol, groups, purposes:
+      The selection of samples, see :py:meth:`objects`
+    modality: str or list of str
+      The modality(ies) to read
+    directory: str
+      The directory of the database. By default, the original directory.
+    extension: str
+      The extension of the image files. By default, the original extension.
+    jobs: int
+      The number of parallel threads reading the files
+
+    Returns
+    -------
+    :py:class:`bob.db.casiasurf.pool.EncodedPool`:
+      The pool, which is also stored as :py:attr:`pool`
+    """
+    from .pool import EncodedPool
+    directory = directory or self.original_directory or ''
+    extension = extension or self.original_extension or '.jpg'
+    filters = self._check_filters(protocol, purposes, groups)
+    files = [(file_id, os.path.join(directory, path + extension), size)
+        for file_id, path, size in self._files_query(filters, modality)]
+    self.pool = EncodedPool.read(files, jobs)
+    return self.pool
+
+
+  def verify(self, directory=None, extension=None, protocol=None, groups=None, purposes=None, modality='all',
+             state_file=None, jobs=4, full=False):
+    """Verifies the image files against the checksums stored in the database
+
+    Checksums are computed by ``create --checksums``. Verification is
+    incremental if a state file is given: files whose size and
+    modification time did not change since they were last verified are
+    skipped.
+
+    Parameters
+    ----------
+    directory: str
+      The directory of the database. By default, the original directory.
+    extension: str
+      The extension of the image files. By default, the original extension.
+    protocol, groups, purposes:
+      The selection of samples, see :py:meth:`objects`
+    modality: str or list of str
+      The modality(ies) to verify
+    state_file: str
+      The file keeping track of the verified files
+    jobs: int
+      The number of parallel threads
+    full: bool
+      If set, all files are verified, even the unchanged ones
+
+    Returns
+    -------
+    tuple:
+      The lists of missing and of corrupted files, the number of skipped
+      files, and the list of files without checksum, see
+      :py:func:`bob.db.casiasurf.checksum.verify`
+
+    Raises
+    ------
+    ValueError
+      If no checksum is stored in the database
+    """
+    from .checksum import verify
+    if self.query(ImageFile.id).filter(ImageFile.checksum.isnot(None)).first() is None:
+      raise ValueError("No checksum is stored in %s; re-create the database with 'bob_dbmanage.py casiasurf create --checksums'" % self.m_sqlite_file)
+    directory = directory or self.original_directory or ''
+    extension = extension or self.original_extension or '.jpg'
+    filters = self._check_filters(protocol, purposes, groups)
+    files = [(os.path.join(directory, path + extension), checksum)
+        for path, checksum in self._files_query(filters, modality).with_entities(ImageFile.path, ImageFile.checksum)]
+    return verify(files, state_file, jobs, full)
+
+
+  def _files_query(self, filters, modality='all'):
+    """Returns the query of the (id, path, size) of the files of the selected samples"""
+    return self._objects_query(**filters)\
+            .join((ImageFile, ImageFile.sample_id == Sample.id))\
+            .filter(ImageFile.modality.in_(modality_list(modality)))\
+            .with_entities(ImageFile.id, ImageFile.path, ImageFile.file_size)\
+            .order_by(ImageFile.id)
+
+
+  def _metadata_rows(self, purposes=None, groups=None, protocol=None):
+    """Streams the metadata of the files of the selected samples
+
+    Yields
+    ------
+    tuple:
+      The values of the :py:data:`METADATA_COLUMNS` for each file
+    """
+    filters = self._check_filters(protocol, purposes, groups, 0, 1)
+    q = self._objects_query(**filters)\
+            .join((ImageFile, ImageFile.sample_id == Sample.id))\
+            .with_entities(Sample.id, ImageFile.id, Sample.group, Sample.attack_type, ImageFile.modality, ImageFile.path)\
+            .order_by(ImageFile.id)
+    for sample_id, file_id, group, attack_type, modality, path in q.yield_per(10000):
+      label = 'attack' if attack_type else 'real'
+      yield (sample_id, file_id, group, attack_type, label, modality, path)
+
+
+  def to_table(self, purposes=None, groups=None, protocol=None):
+    """Returns the metadata of the files of the selected samples as a table
+
+    The table has one row per file, with the :py:data:`METADATA_COLUMNS`,
+    and is retrieved with a single SQL query. Parameters are the same as
+    for :py:meth:`objects`.
+
+    Returns
+    -------
+    :py:class:`pyarrow.Table` or dict:
+      The table, or a dictionary of columns (as :py:class:`numpy.ndarray`)
+      if ``pyarrow`` is not installed
+    """
+    columns = [[] for _ in METADATA_COLUMNS]
+    for row in self._metadata_rows(purposes, groups, protocol):
+      for column, value in zip(columns, row):
+        column.append(value)
+
+    try:
+      import pyarrow
+    except ImportError:
+      import numpy
+      return dict((name, numpy.array(column)) for name, column in zip(METADATA_COLUMNS, columns))
+    return pyarrow.Table.from_arrays([pyarrow.array(c) for c in columns], names=list(METADATA_COLUMNS))
+
+
+  def export_metadata(self, filename, format=None, purposes=None, groups=None, protocol=None):
+    """Writes the metadata of the files of the selected samples to a file
+
+    Parameters
+    ----------
+    filename: str
+      The file to write
+    format: str
+      'parquet', 'arrow' or 'csv'. By default, it is guessed from the
+      extension of the file. Parquet and Arrow files require ``pyarrow``.
+
+    Other parameters are the same as for :py:meth:`objects`.
+    """
+    if format is None:
+      extension = os.path.splitext(filename)[1].lower()
+      format = {'.parquet': 'parquet', '.arrow': 'arrow', '.feather': 'arrow'}.get(extension, 'csv')
+
+    if format == 'csv':
+      import csv
+      with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(METADATA_COLUMNS)
+        writer.writerows(self._metadata_rows(purposes, groups, protocol))
+      return
+
+    table = self.to_table(purposes, groups, protocol)
+    if isinstance(table, dict):
+      raise ImportError("Writing %s files requires pyarrow, which is not installed; use the CSV format instead" % format)
+    if format == 'parquet':
+      import pyarrow.parquet
+      pyarrow.parquet.write_table(table, filename)
+    elif format == 'arrow':
+      import pyarrow.feather
+      pyarrow.feather.write_feather(table, filename)
+    else:
+      raise ValueError("Unknown metadata format '%s'" % format)
+
+
+  def _check_filters(self, protocol=None, purposes=None, groups=None, shard_index=0, num_shards=1, complete=False, subjects=None, attack_types=None):
+    """Validates the query parameters of :py:meth:`objects` and friends
+
+    Returns
+    -------
+    dict:
+      The validated parameters, to be given to :py:meth:`_objects_query`
+    """
+    if protocol is None:
+      protocol = self.protocol
+    protocol = self.check_parameter_for_validity(protocol, "protocol", self.protocols())
     purposes = self.check_parameters_for_validity(purposes, "purpose", self.purposes())
     groups = self.check_parameters_for_validity(groups, "group", self.groups())
+    if attack_types is not None:
+      attack_types = sorted(set(int(a) for a in ((attack_types,) if isinstance(attack_types, numbers.Integral) else attack_types)))
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+      raise ValueError("Shard index %d is not valid for %d shard(s)" % (shard_index, num_shards))
+    return dict(
+      protocol=protocol,
+      purposes=sorted(purposes),
+      groups=sorted(groups),
+      shard_index=shard_index,
+      num_shards=num_shards,
+      complete=bool(complete),
+      subjects=sorted([subjects] if isinstance(subjects, str) else subjects) if subjects is not None else None,
+      attack_types=attack_types,
+    )
 
+
+  def _objects_query(self, protocol, purposes, groups, shard_index=0, num_shards=1, complete=False, subjects=None, attack_types=None):
+    """Returns the query of the samples with the given (validated) properties"""
     q = self.query(Sample)\
                        .join((ProtocolPurpose, Sample.protocolPurposes))\
+                       .join((Protocol, ProtocolPurpose.protocol))\
+                       .filter(Protocol.name == protocol)\
                        .filter(ProtocolPurpose.group.in_(groups))\
-                       .filter(ProtocolPurpose.purpose.in_(purposes))\
-                       .order_by(Sample.id)
+                       .filter(ProtocolPurpose.purpose.in_(purposes))
+
+    if complete:
+      mask = modality_mask(modality_list(protocol))
+      if mask == COMPLETE_MODALITIES:
+        q = q.filter(Sample.modalities == mask)
+      else:
+        q = q.filter(Sample.modalities.op('&')(mask) == mask)
+
+    if subjects is not None:
+      q = q.filter(Sample.subject.in_(subjects))
+
+    if attack_types is not None:
+      q = q.filter(Sample.attack_type.in_(attack_types))
+
+    if num_shards > 1:
+      from sqlalchemy import func
+      ranked = q.with_entities(Sample.id.label('id'),
+          func.row_number().over(order_by=Sample.id).label('rank')).subquery()
+      shard = self.query(ranked.c.id).filter((ranked.c.rank - 1) % num_shards == shard_index)
+      q = q.filter(Sample.id.in_(shard))
 
-    retval = list(set(q))
-    return list(set(retval))  
+    return q.order_by(Sample.id)
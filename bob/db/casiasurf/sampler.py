@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Class-balanced and attack-type-stratified batch samplers
+"""
+
+import numpy
+
+
+class BatchSampler(object):
+  """Draws balanced or stratified batches of sample ids
+
+  The ids of the selected samples are indexed once by attack type, so that
+  drawing a batch only costs O(batch_size). Samples are drawn with
+  replacement, and the batches can directly be given to
+  :py:meth:`bob.db.casiasurf.Database.load_batches`.
+
+  Parameters
+  ----------
+  database: :py:class:`bob.db.casiasurf.Database`
+    The database to draw samples from
+  batch_size: int
+    The number of sample ids in each batch
+  strategy: str
+    'balanced' to draw as many real samples as attacks (attacks being drawn
+    regardless of their type), or 'stratified' to draw as many samples of
+    each attack type (real samples being of type 0).
+  protocol: str
+    The protocol to consider (see :py:meth:`bob.db.casiasurf.Database.objects`)
+  groups: str or tuple
+    The group(s) to draw samples from
+  num_batches: int
+    The number of batches to draw. If ``None``, the number of batches of an
+    epoch (i.e. the number of samples divided by the batch size) is drawn.
+  seed: int
+    The seed of the random number generator
+
+  """
+
+  def __init__(self, database, batch_size, strategy='balanced', protocol=None, groups='train', num_batches=None, seed=None):
+
+    if strategy not in ('balanced', 'stratified'):
+      raise ValueError("Unknown sampling strategy '%s'" % strategy)
+
+    index = database.sample_ids_by_attack_type(protocol=protocol, groups=groups)
+    if strategy == 'balanced':
+      attacks = [ids for attack_type, ids in sorted(index.items()) if attack_type != 0]
+      strata = [index.get(0, numpy.array([], dtype=object))]
+      strata.append(numpy.concatenate(attacks) if attacks else numpy.array([], dtype=object))
+    else:
+      strata = [index[attack_type] for attack_type in sorted(index)]
+
+    if not strata or any(len(s) == 0 for s in strata):
+      raise ValueError("Cannot draw '%s' batches: some classes have no samples" % strategy)
+
+    self.strata = strata
+    self.batch_size = batch_size
+    self.strategy = strategy
+    if num_batches is None:
+      num_batches = sum(len(s) for s in strata) // batch_size
+    self.num_batches = num_batches
+    self.rng = numpy.random.RandomState(seed)
+
+  def __len__(self):
+    return self.num_batches
+
+  def __iter__(self):
+    for _ in range(self.num_batches):
+      yield self.draw()
+
+  def draw(self):
+    """Draws a single batch
+
+    Returns
+    -------
+    :py:class:`numpy.ndarray`:
+      The (shuffled) ids of the samples in the batch
+    """
+    n_strata = len(self.strata)
+    counts = numpy.full(n_strata, self.batch_size // n_strata, dtype=int)
+    # the remainder goes to randomly chosen strata
+    counts[self.rng.choice(n_strata, self.batch_size % n_strata, replace=False)] += 1
+
+    batch = numpy.concatenate([s[self.rng.randint(0, len(s), c)] for s, c in zip(self.strata, counts)])
+    self.rng.shuffle(batch)
+    return batch
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Local-scratch staging of the image files
+
+Files read from a (slow, e.g. network) original directory are copied to a
+local scratch directory the first time they are read, and served from the
+local copy afterwards. The total size of the copies is bounded: the least
+recently used ones are evicted first. The staging directory can be shared
+by several processes.
+
+Copies are verified against the size and, if known, the checksum of the
+original file when they are made; only their size is checked when they are
+served. The cache of a database is registered for its original directory
+(see :py:func:`register`), so that images of this directory are
+transparently read from their local copies.
+"""
+
+import os
+import hashlib
+import threading
+import tempfile
+
+import bob.core
+logger = bob.core.log.setup('bob.db.casiasurf')
+
+from .metrics import registry as metrics
+
+# caches registered in the current process, by original directory
+_caches = {}
+
+
+def register(directory, cache):
+  """Registers the cache of the files of an original directory"""
+  _caches[os.path.abspath(directory)] = cache
+
+
+def lookup(directory):
+  """Returns the cache registered for an original directory, if any"""
+  return _caches.get(os.path.abspath(directory))
+
+
+class StagingCache(object):
+  """A size-bounded, least-recently-used cache of files on local scratch
+
+  Parameters
+  ----------
+  directory: str
+    The local scratch directory
+  max_bytes: int
+    The maximum total size of the local copies. If ``None``, the size is
+    not bounded.
+  """
+
+  def __init__(self, directory, max_bytes=None):
+    self.directory = directory
+    self.max_bytes = max_bytes
+    # the accounting is shared by the threads of the process (e.g. prefetching)
+    self.lock = threading.Lock()
+    self._evicting = threading.Lock()
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    self._size = sum(size for _, _, size in self._entries())
+
+  def _entries(self):
+    """Lists the local copies, as (path, last use, size)"""
+    for root, _, files in os.walk(self.directory):
+      for name in files:
+        if name.endswith('.tmp'):
+          # being copied
+          continue
+        path = os.path.join(root, name)
+        try:
+          stat = os.stat(path)
+        except OSError:
+          # evicted by another process
+          continue
+        yield path, stat.st_mtime, stat.st_size
+
+  def local_path(self, filename):
+    """Returns the path of the local copy of a file"""
+    key = hashlib.sha1(os.path.abspath(filename).encode('utf-8')).hexdigest()
+    return os.path.join(self.directory, key[:2], key + os.path.splitext(filename)[1])
+
+  def fetch(self, filename, expected_size=None, expected_checksum=None, on_read=None):
+    """Returns the path of the local copy of a file, copying it if needed
+
+    Parameters
+    ----------
+    filename: str
+      The original file
+    expected_size: int
+      The size of the file, if known (e.g. :py:attr:`ImageFile.file_size`).
+      Local copies of another size are considered as corrupted, and are
+      copied again.
+    expected_checksum: str
+      The checksum of the file, if known (e.g. :py:attr:`ImageFile.checksum`),
+      against which new copies are verified
+    on_read: callable
+      If given, called with the number of bytes of each chunk read from the
+      original file (e.g. to limit the bandwidth). It is not called when the
+      local copy already exists.
+
+    Returns
+    -------
+    str:
+      The path to the (verified) local copy
+
+    Raises
+    ------
+    IOError
+      If the copy does not have the expected size or checksum
+    """
+    local = self.local_path(filename)
+    try:
+      size = os.path.getsize(local)
+      if expected_size is None or size == expected_size:
+        # marks the copy as recently used
+        os.utime(local, None)
+        metrics.incr('staging.hits')
+        return local
+    except OSError:
+      # not copied yet, or evicted by another process
+      size = None
+
+    if size is not None:
+      logger.warn("Local copy {} of {} is corrupted, copying it again".format(local, filename))
+    metrics.incr('staging.copies')
+    return self._copy(filename, local, expected_size, expected_checksum, replacing=size is not None, on_read=on_read)
+
+  def _copy(self, filename, local, expected_size, expected_checksum=None, replacing=False, on_read=None):
+    """Copies a file to the scratch directory (write-then-rename)
+
+    If ``replacing`` is set, a (corrupted) copy of the file is replaced: its
+    size was already accounted for when it was made.
+    """
+    from .checksum import new_hash
+    source_size = os.path.getsize(filename)
+    if expected_size is not None and source_size != expected_size:
+      raise IOError("File %s has %d bytes, but %d were expected" % (filename, source_size, expected_size))
+
+    directory = os.path.dirname(local)
+    if not os.path.exists(directory):
+      os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    h = new_hash()
+    with os.fdopen(fd, 'wb') as f, open(filename, 'rb') as source:
+      for chunk in iter(lambda: source.read(1024 * 1024), b''):
+        if on_read is not None:
+          on_read(len(chunk))
+        h.update(chunk)
+        f.write(chunk)
+    if os.path.getsize(tmp) != source_size:
+      os.unlink(tmp)
+      raise IOError("Could not copy %s to %s: the copy is truncated" % (filename, local))
+    if expected_checksum is not None and h.hexdigest() != expected_checksum:
+      os.unlink(tmp)
+      raise IOError("File %s does not match its checksum" % filename)
+    os.replace(tmp, local)
+
+    with self.lock:
+      if not replacing:
+        self._size += source_size
+      full = self.max_bytes is not None and self._size > self.max_bytes
+    if full:
+      self.evict()
+    return local
+
+  def evict(self):
+    """Removes the least recently used copies, until 90% of the maximum size is used
+
+    A single thread of the process evicts at a time; the others carry on
+    copying.
+    """
+    if not self._evicting.acquire(False):
+      return
+    try:
+      self._evict()
+    finally:
+      self._evicting.release()
+
+  def _evict(self):
+    with self.lock:
+      before = self._size
+    entries = sorted(self._entries(), key=lambda e: e[1])
+    total = sum(size for _, _, size in entries)
+    target = 0.9 * self.max_bytes if self.max_bytes is not None else total
+    for path, _, size in entries:
+      if total <= target:
+        break
+      try:
+        os.unlink(path)
+      except OSError:
+        continue
+      total -= size
+    with self.lock:
+      # resynchronised with the directory, keeping the copies made meanwhile
+      self._size = total + self._size - before
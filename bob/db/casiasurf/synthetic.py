@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Synthetic CASIA-SURF trees, for tests and benchmarks
+
+The generated tree has the exact layout of the original database, as
+parsed by :py:mod:`bob.db.casiasurf.create`::
+
+  Training/real_part/<subject>/real.rssdk/{color,ir,depth}/<frame>.jpg
+  Training/fake_part/<subject>/<attack type>_enm_b.rssdk/{color,ir,depth}/<frame>.jpg
+  Val/<video>/<frame>-{color,ir,depth}.jpg
+  Testing/<video>/<frame>-{color,ir,depth}.jpg
+
+along with the label files of the validation and test sets.
+"""
+
+import os
+import argparse
+
+import numpy
+
+import bob.io.base
+import bob.io.image
+
+# name of the directory of each modality in the training set
+STREAMS = ('color', 'ir', 'depth')
+
+
+def _save(rng, filename, stream, image_size):
+  """Saves a random image (3-channel for color, grayscale otherwise)"""
+  directory = os.path.dirname(filename)
+  if not os.path.exists(directory):
+    os.makedirs(directory)
+  shape = (3,) + tuple(image_size) if stream == 'color' else tuple(image_size)
+  bob.io.base.save(rng.randint(0, 255, shape).astype(numpy.uint8), filename)
+
+
+def _generate_split(rng, imagesdir, label_filename, name, n_samples, frames_per_video, attack_ratio, image_size):
+  """Generates the images and labels of the validation or the test set"""
+  with open(label_filename, 'w') as labels:
+    for k in range(n_samples):
+      stem = '%s/%04d/%06d' % (name, k // frames_per_video, k)
+      for stream in STREAMS:
+        _save(rng, os.path.join(imagesdir, '%s-%s.jpg' % (stem, stream)), stream, image_size)
+      label = 0 if rng.rand() < attack_ratio else 1
+      labels.write(' '.join('%s-%s.jpg' % (stem, stream) for stream in STREAMS) + ' %d\n' % label)
+
+
+def generate(directory, n_subjects=4, n_frames=5, attack_types=(1, 2, 3, 4, 5, 6), n_validation=20,
+             n_test=20, frames_per_video=5, attack_ratio=0.7, image_size=(32, 32), seed=0):
+  """Generates a synthetic CASIA-SURF tree
+
+  Parameters
+  ----------
+  directory: str
+    The directory where the images and label files are generated
+  n_subjects: int
+    The number of subjects of the training set
+  n_frames: int
+    The number of frames of each (real or attack) training video
+  attack_types: tuple
+    The attack types of the training set
+  n_validation: int
+    The number of samples of the validation set
+  n_test: int
+    The number of samples of the test set
+  frames_per_video: int
+    The number of samples in each directory of the validation and test sets
+  attack_ratio: float
+    The probability of a validation or test sample to be an attack
+  image_size: tuple
+    The (height, width) of the images
+  seed: int
+    The seed of the random number generator
+
+  Returns
+  -------
+  tuple:
+    The images directory (with a trailing separator, as expected by
+    ``create``), the validation label file and the test label file
+  """
+  rng = numpy.random.RandomState(seed)
+  imagesdir = os.path.join(directory, 'images') + os.sep
+
+  for s in range(n_subjects):
+    subject = 'SYNT_AS%04d' % s
+    videos = [('real_part', 'real.rssdk')]
+    videos += [('fake_part', '%02d_enm_b.rssdk' % a) for a in attack_types]
+    for part, video in videos:
+      for frame in range(n_frames):
+        for stream in STREAMS:
+          filename = os.path.join(imagesdir, 'Training', part, subject, video, stream, '%d.jpg' % (frame * 10))
+          _save(rng, filename, stream, image_size)
+
+  validation_label_filename = os.path.join(directory, 'val_public_list_with_label.txt')
+  _generate_split(rng, imagesdir, validation_label_filename, 'Val', n_validation, frames_per_video, attack_ratio, image_size)
+  test_label_filename = os.path.join(directory, 'test_private_list.txt')
+  _generate_split(rng, imagesdir, test_label_filename, 'Testing', n_test, frames_per_video, attack_ratio, image_size)
+
+  return imagesdir, validation_label_filename, test_label_filename
+
+
+def create_database(dbfile, imagesdir, validation_label_filename, test_label_filename, **options):
+  """Creates an SQLite file for a (synthetic) tree, as ``create`` would
+
+  Parameters
+  ----------
+  dbfile: str
+    The SQLite file to create
+  imagesdir, validation_label_filename, test_label_filename: str
+    The tree, as returned by :py:func:`generate`
+  options:
+    The options of the ``create`` command (e.g. ``jobs``, ``checksums``)
+  """
+  from .create import create
+  args = argparse.Namespace(
+    type='sqlite',
+    files=[dbfile],
+    recreate=True,
+    verbose=0,
+    imagesdir=imagesdir,
+    validlabel=validation_label_filename,
+    testlabel=test_label_filename,
+    thumbnails_size=0,
+    annotations_dir=None,
+    annotations_ext='.json',
+    checksums=False,
+    jobs=1,
+    serial=False,
+  )
+  for key, value in options.items():
+    setattr(args, key, value)
+  return create(args)
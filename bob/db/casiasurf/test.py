@@ -25,6 +25,73 @@ def db_available(test):
   return wrapper
 
 
+class SyntheticTree(object):
+  """A synthetic tree in a temporary directory, see :py:func:`bob.db.casiasurf.synthetic.generate`
+
+  It is removed with :py:meth:`remove`, or when used as a context manager.
+  """
+
+  def __init__(self, **options):
+    import tempfile
+    from bob.db.casiasurf.synthetic import generate
+    self.directory = tempfile.mkdtemp()
+    self.imagesdir, self.validlabel, self.testlabel = generate(self.directory, **options)
+    self.dbfile = os.path.join(self.directory, 'db.sql3')
+
+  def create(self, dbfile=None, **options):
+    """Creates (or re-creates) a database of the tree, by default in :py:attr:`dbfile`"""
+    from bob.db.casiasurf.synthetic import create_database
+    assert create_database(dbfile or self.dbfile, self.imagesdir, self.validlabel, self.testlabel, **options) == 0
+
+  def database(self, dbfile=None, **kwargs):
+    """Returns the database of the tree"""
+    options = dict(original_directory=self.imagesdir, original_extension='.jpg', sqlite_file=dbfile or self.dbfile)
+    options.update(kwargs)
+    return bob.db.casiasurf.Database(**options)
+
+  def remove(self):
+    import shutil
+    shutil.rmtree(self.directory)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.remove()
+
+
+# the synthetic database of the query tests, created once for the module
+synthetic = None
+
+# the (topleft, bottomright) annotations of a few files of the synthetic database
+ANNOTATIONS = {
+  'Val/0000/000000-color': ((2, 3), (20, 25)),
+  'Val/0000/000000-depth': ((4, 5), (22, 27)),
+  'Val/0000/000001-color': ((1.5, 2.5), (30, 31)),
+  'Val/0000/000002-depth': ((0, 0), (32, 32)),
+}
+
+
+def setup_module():
+  import json
+  global synthetic
+  synthetic = SyntheticTree(n_subjects=2, n_frames=3, attack_types=(1, 2), n_validation=100)
+  annotations_dir = os.path.join(synthetic.directory, 'annotations')
+  for path, (topleft, bottomright) in ANNOTATIONS.items():
+    if not os.path.exists(os.path.dirname(os.path.join(annotations_dir, path))):
+      os.makedirs(os.path.dirname(os.path.join(annotations_dir, path)))
+    with open(os.path.join(annotations_dir, path + '.json'), 'w') as f:
+      json.dump(dict(topleft=topleft, bottomright=bottomright), f)
+  # an annotation file without face
+  with open(os.path.join(annotations_dir, 'Val/0000/000003-color.json'), 'w') as f:
+    json.dump({}, f)
+  synthetic.create(annotations_dir=annotations_dir)
+
+
+def teardown_module():
+  synthetic.remove()
+
+
 def test_objects():
 
   # tests if the right number of sample objects is returned
@@ -38,3 +105,693 @@ def test_objects():
   assert len(db.objects(groups=('test',), purposes=('real',))) == 17458
   assert len(db.objects(groups=('test',), purposes=('attack',))) == 40252 
   assert len(db.objects(groups=('test',), purposes=('real', 'attack'))) == 57710
+
+
+def test_read_only():
+
+  # tests that the immutable read-only mode returns the same samples
+  
+  reference = synthetic.database()
+  db = synthetic.database(read_only=True)
+  assert db.read_only
+  for purpose in ('real', 'attack'):
+    assert [s.id for s in db.objects(groups=('validation',), purposes=(purpose,))] == \
+        [s.id for s in reference.objects(groups=('validation',), purposes=(purpose,))]
+
+
+def test_pickle():
+
+  # tests that the database and its samples survive pickling
+  import pickle
+
+  db = synthetic.database(original_directory='/tmp', protocol='color')
+  db2 = pickle.loads(pickle.dumps(db))
+  assert db2.original_directory == '/tmp'
+  assert db2.protocol == 'color'
+
+  sample = db2.objects(groups=('validation',), purposes=('real',))[0]
+  sample2 = pickle.loads(pickle.dumps(sample))
+  assert sample2.id == sample.id
+  assert sample2.attack_type == sample.attack_type
+  assert sorted(f.path for f in sample2.files) == sorted(f.path for f in sample.files)
+  # the header information is kept (e.g. to verify local copies)
+  assert sorted((f.path, f.file_size, f.width) for f in sample2.files) == sorted((f.path, f.file_size, f.width) for f in sample.files)
+
+
+def test_query_cache():
+
+  # tests that memoised results are the same as the ones from the database
+  import tempfile, shutil
+  from bob.db.casiasurf import cache
+
+  directory = tempfile.mkdtemp()
+  try:
+    db = synthetic.database(query_cache='disk', query_cache_directory=directory)
+    reference = [s.id for s in db.objects(groups=('validation',), purposes=('real',))]
+    assert len(reference) == synthetic.database().count_objects(groups=('validation',), purposes=('real',))
+    assert len(os.listdir(directory)) == 1
+
+    # in-process tier
+    assert [s.id for s in db.objects(groups=('validation',), purposes=('real',))] == reference
+
+    # on-disk tier
+    cache.clear()
+    samples = db.objects(groups=('validation',), purposes=('real',))
+    assert [s.id for s in samples] == reference
+    assert len(samples[0].files) > 0
+  finally:
+    cache.clear()
+    shutil.rmtree(directory)
+
+
+def test_shards():
+
+  # tests that shards are a balanced partition of the samples
+  
+  db = synthetic.database()
+  reference = [s.id for s in db.objects(groups=('validation',))]
+  shards = [[s.id for s in db.objects(groups=('validation',), shard_index=i, num_shards=3)] for i in range(3)]
+  assert sorted(sum(shards, [])) == reference
+  assert max(len(s) for s in shards) - min(len(s) for s in shards) <= 1
+  assert shards[1] == reference[1::3]
+
+  streamed = [s.id for s in db.iter_objects(groups=('validation',), shard_index=1, num_shards=3, chunk_size=7)]
+  assert streamed == shards[1]
+
+  # sharded iterations are resumable too
+  iterator = db.iter_objects(groups=('validation',), shard_index=1, num_shards=3, chunk_size=7)
+  first = [next(iterator).id for _ in range(15)]
+  rest = [s.id for s in db.resume(iterator.cursor(), chunk_size=7)]
+  assert first + rest == shards[1]
+
+
+def test_batch_sampler():
+
+  # tests the composition and reproducibility of the drawn batches
+  import numpy
+  from bob.db.casiasurf import BatchSampler
+
+  class FakeDatabase(object):
+    def sample_ids_by_attack_type(self, protocol=None, groups=None):
+      return {
+        0: numpy.array(['r%d' % i for i in range(10)], dtype=object),
+        1: numpy.array(['a%d' % i for i in range(100)], dtype=object),
+        2: numpy.array(['b%d' % i for i in range(50)], dtype=object),
+      }
+
+  sampler = BatchSampler(FakeDatabase(), 10, strategy='balanced', seed=0)
+  assert len(sampler) == 16
+  batches = list(sampler)
+  assert all(len(b) == 10 for b in batches)
+  assert all(sum(i.startswith('r') for i in b) == 5 for b in batches)
+  assert all(numpy.array_equal(b1, b2) for b1, b2 in zip(batches, BatchSampler(FakeDatabase(), 10, seed=0)))
+
+  sampler = BatchSampler(FakeDatabase(), 9, strategy='stratified', num_batches=3, seed=1)
+  for b in sampler:
+    assert [sum(i.startswith(p) for i in b) for p in 'rab'] == [3, 3, 3]
+
+
+def test_get_samples():
+
+  # tests that samples are returned in the order of the given ids
+  
+  db = synthetic.database()
+  ids = [s.id for s in db.objects(groups=('validation',))][::-7]
+  samples = db.get_samples(ids, chunk_size=5)
+  assert [s.id for s in samples] == ids
+  assert all(len(s.files) > 0 for s in samples)
+
+  try:
+    db.get_samples(['no-such-sample'])
+    assert False, "a KeyError should have been raised"
+  except KeyError:
+    pass
+
+
+def test_export_metadata():
+
+  # tests that the exported metadata has one row per file
+  import csv, tempfile
+  
+  db = synthetic.database()
+  samples = db.objects(groups=('validation',), purposes=('real',))
+  n_files = sum(len(s.files) for s in samples)
+
+  with tempfile.NamedTemporaryFile(suffix='.csv', mode='r') as f:
+    db.export_metadata(f.name, groups=('validation',), purposes=('real',))
+    rows = list(csv.reader(f))
+  assert tuple(rows[0]) == bob.db.casiasurf.query.METADATA_COLUMNS
+  assert len(rows) == n_files + 1
+  assert all(r[4] == 'real' for r in rows[1:])
+
+
+def test_load_image():
+
+  # tests the reduced-resolution and grayscale decoding of images
+  import numpy, tempfile
+  import bob.io.base
+  from PIL import Image
+  from bob.db.casiasurf.models import load_image, _decode_pil
+
+  image = numpy.random.RandomState(0).randint(0, 255, (3, 240, 320)).astype(numpy.uint8)
+  with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+    bob.io.base.save(image, f.name)
+    assert load_image(f.name).shape == (3, 240, 320)
+    assert load_image(f.name, size=(112, 112)).shape == (3, 112, 112)
+    assert load_image(f.name, gray=True).shape == (240, 320)
+    assert load_image(f.name, size=(60, 80), gray=True).shape == (60, 80)
+    # JPEG images are decoded directly as grayscale, with or without resizing
+    for size in (None, (60, 80)):
+      opened = Image.open(f.name)
+      _decode_pil(opened, size, True)
+      assert opened.mode == 'L'
+
+  # without DCT downscaling, resizing while loading is the same as resizing afterwards
+  from bob.db.casiasurf.models import resize_image
+  with tempfile.NamedTemporaryFile(suffix='.png') as f:
+    bob.io.base.save(image, f.name)
+    assert (load_image(f.name, size=(60, 80)) == resize_image(load_image(f.name), (60, 80))).all()
+
+
+def test_crop_and_resize():
+
+  # tests the normalisation of the thumbnails
+  import numpy
+  from bob.db.casiasurf.thumbnails import crop_and_resize
+
+  image = numpy.zeros((3, 100, 80), dtype=numpy.uint8)
+  image[:, 10:60, 20:70] = 255
+  thumbnail = crop_and_resize(image, (32, 32), bbox=((10, 20), (60, 70)))
+  assert thumbnail.shape == (3, 32, 32)
+  assert (thumbnail == 255).all()
+  assert crop_and_resize(image[0], (16, 24)).shape == (16, 24)
+
+
+def test_annotations():
+
+  # tests the ingestion of the annotations, and their bulk retrieval
+  import numpy
+  
+  db = synthetic.database()
+  samples = db.objects(groups=('validation',))
+  expected = {}
+  for s in samples:
+    for f in s.files:
+      if f.path in ANNOTATIONS:
+        expected.setdefault(s.id, {})[f.modality] = dict(zip(('topleft', 'bottomright'), ANNOTATIONS[f.path]))
+  assert len(expected) == 3
+  assert db.annotations(samples) == expected
+  assert db.annotations([s.id for s in samples], modality='depth') == \
+      dict((i, {'depth': a['depth']}) for i, a in expected.items() if 'depth' in a)
+
+  array = db.annotations(samples, modality='color', as_array=True)
+  assert array.shape == (len(samples), 4)
+  for s, row in zip(samples, array):
+    path = [f.path for f in s.files if f.modality == 'color'][0]
+    if path in ANNOTATIONS:
+      assert tuple(row) == ANNOTATIONS[path][0] + ANNOTATIONS[path][1]
+    else:
+      assert numpy.isnan(row).all()
+
+
+def test_read_image_header():
+
+  # tests that the dimensions are read from the JPEG header
+  import numpy, tempfile
+  import bob.io.base
+  from bob.db.casiasurf.create import read_image_header
+
+  image = numpy.zeros((3, 120, 90), dtype=numpy.uint8)
+  with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+    bob.io.base.save(image, f.name)
+    width, height, channels, file_size = read_image_header(f.name)
+  assert (width, height, channels) == (90, 120, 3)
+  assert file_size > 0
+
+
+def test_complete():
+
+  # tests the filtering of samples having all modalities
+  
+  db = synthetic.database()
+  complete = db.objects(groups=('validation',), complete=True)
+  assert len(complete) <= db.count_objects(groups=('validation',))
+  assert all(s.is_complete() for s in complete)
+  assert len(db.objects(protocol='color', groups=('validation',), complete=True)) >= len(complete)
+
+
+def test_subjects():
+
+  # tests the selection of samples by subject
+  
+  db = synthetic.database()
+  subjects = db.subjects(groups=('train',))
+  assert len(subjects) > 0
+  assert db.subjects(groups=('validation',)) == []
+
+  counts = db.subjects(groups=('train',), counts=True)
+  assert sorted(counts) == subjects
+  samples = db.objects(groups=('train',), subjects=subjects[0])
+  assert len(samples) == counts[subjects[0]][0]
+  assert all(s.subject == subjects[0] for s in samples)
+
+
+def test_attack_types():
+
+  # tests the filtering and counting of samples by attack type
+  
+  db = synthetic.database()
+  n_real = db.count_objects(groups=('train',), purposes=('real',))
+  assert n_real > 0
+  assert db.count_objects(groups=('train',), attack_types=0) == n_real
+  index = db.sample_ids_by_attack_type(groups=('train',))
+  for attack_type, ids in index.items():
+    assert db.count_objects(groups=('train',), attack_types=(attack_type,)) == len(ids)
+  attack_type = max(index)
+  samples = db.objects(groups=('train',), attack_types=attack_type)
+  import numpy
+  assert [s.id for s in db.objects(groups=('train',), attack_types=numpy.int64(attack_type))] == [s.id for s in samples]
+  assert [s.id for s in samples] == sorted(index[attack_type])
+  assert [s.id for s in db.iter_objects(groups=('train',), attack_types=attack_type)] == [s.id for s in samples]
+
+
+def test_stats():
+
+  # tests that the aggregates match the number of samples
+  
+  db = synthetic.database()
+  rows = db.stats(protocol='color', groups=('validation',), with_bytes=True)
+  samples = db.objects(protocol='color', groups=('validation',), purposes=('real',))
+  assert sum(r['files'] for r in rows if r['purpose'] == 'real') == sum(len(s.files) for s in samples)
+  assert max(r['samples'] for r in rows if r['purpose'] == 'real') <= len(samples)
+  assert all(r['modality'] in (None, 'color', 'infrared', 'depth') for r in rows)
+  assert all('bytes' in r for r in rows)
+
+
+def test_staging():
+
+  # tests the copy, verification and eviction of local copies
+  import tempfile, shutil
+  from bob.db.casiasurf.staging import StagingCache
+
+  source = tempfile.mkdtemp()
+  scratch = tempfile.mkdtemp()
+  try:
+    filenames = []
+    for i in range(4):
+      filenames.append(os.path.join(source, '%d.jpg' % i))
+      with open(filenames[-1], 'wb') as f:
+        f.write(b'x' * 100)
+
+    cache = StagingCache(scratch, max_bytes=250)
+    local = cache.fetch(filenames[0], 100)
+    assert local != filenames[0]
+    assert open(local, 'rb').read() == b'x' * 100
+    assert cache.fetch(filenames[0], 100) == local
+
+    # corrupted copies are replaced, and only accounted for once
+    with open(local, 'wb') as f:
+      f.write(b'x')
+    assert os.path.getsize(cache.fetch(filenames[0], 100)) == 100
+    assert cache._size == 100
+
+    # copies are verified against the checksums
+    from nose.tools import assert_raises
+    from bob.db.casiasurf.checksum import file_checksum
+    os.unlink(local)
+    assert_raises(IOError, cache.fetch, filenames[0], 100, '0' * 32)
+    assert cache.fetch(filenames[0], 100, file_checksum(filenames[0])) == local
+
+    for filename in filenames[1:]:
+      cache.fetch(filename)
+    assert cache._size <= 250
+    assert os.path.exists(cache.local_path(filenames[-1]))
+    assert not os.path.exists(cache.local_path(filenames[0]))
+  finally:
+    shutil.rmtree(source)
+    shutil.rmtree(scratch)
+
+
+def test_prefetch_files():
+
+  # tests that all files are read, or copied to scratch
+  import tempfile, shutil
+  from bob.db.casiasurf.prefetch import prefetch_files
+  from bob.db.casiasurf.staging import StagingCache
+
+  source = tempfile.mkdtemp()
+  scratch = tempfile.mkdtemp()
+  try:
+    files = []
+    for i in range(10):
+      files.append((os.path.join(source, '%d.jpg' % i), 1000))
+      with open(files[-1][0], 'wb') as f:
+        f.write(b'x' * 1000)
+
+    progress = []
+    assert prefetch_files(files, jobs=3, callback=lambda *a: progress.append(a)) == (10, 10000)
+    assert progress[-1] == (10, 10000, 10)
+
+    # only the bytes actually read are charged to the bandwidth
+    import time
+    start = time.time()
+    assert prefetch_files(files, jobs=3, max_bandwidth=1e6) == (10, 10000)
+    assert time.time() - start < 0.5
+
+    staging = StagingCache(scratch)
+    assert prefetch_files(files, staging=staging, jobs=3, max_bandwidth=1e6) == (10, 10000)
+    assert all(os.path.exists(staging.local_path(f)) for f, _ in files)
+
+    # files already on scratch are not charged
+    start = time.time()
+    assert prefetch_files(files, staging=staging, jobs=3, max_bandwidth=1000) == (10, 10000)
+    assert time.time() - start < 0.5
+  finally:
+    shutil.rmtree(source)
+    shutil.rmtree(scratch)
+
+
+def test_read_order():
+
+  # tests that samples are read by location, whatever the requested order
+  from bob.db.casiasurf.models import _rebuild_sample
+
+  samples = [
+    _rebuild_sample('b', 'train', 0, [(1, 'Training/b/color/1', 'color')]),
+    _rebuild_sample('c', 'train', 0, [(2, 'Training/c/color/1', 'color')]),
+    _rebuild_sample('a', 'train', 0, [(3, 'Training/a/color/1', 'color'), (4, 'Training/a/depth/1', 'depth')]),
+  ]
+  db = bob.db.casiasurf.Database()
+  assert list(db._read_order(samples, None, None, None)) == [0, 1, 2]
+  assert db._read_order(samples, None, None, 'path') == [2, 0, 1]
+  assert sorted(db._read_order(samples, '/nonexistent', '.jpg', 'inode')) == [0, 1, 2]
+
+
+def test_encoded_pool():
+
+  # tests that images decoded from memory are the same as from files
+  import numpy, tempfile, shutil
+  import bob.io.base
+  from bob.db.casiasurf.pool import EncodedPool
+  from bob.db.casiasurf.models import load_image, decode_image
+
+  directory = tempfile.mkdtemp()
+  try:
+    files = []
+    for i in range(3):
+      image = numpy.random.RandomState(i).randint(0, 255, (3, 40, 30)).astype(numpy.uint8)
+      filename = os.path.join(directory, '%d.jpg' % i)
+      bob.io.base.save(image, filename)
+      files.append((i + 1, filename, None))
+
+    pool = EncodedPool.read(files, jobs=2)
+    assert len(pool) == 3
+    assert pool.nbytes == sum(os.path.getsize(f) for _, f, _ in files)
+    for file_id, filename, _ in files:
+      assert bytes(pool.get(file_id)) == open(filename, 'rb').read()
+      assert (decode_image(pool.get(file_id)) == load_image(filename)).all()
+      assert (decode_image(pool.get(file_id), gray=True) == load_image(filename, gray=True)).all()
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_verify():
+
+  # tests the incremental verification of checksums
+  import tempfile, shutil
+  from bob.db.casiasurf.checksum import file_checksum, verify
+
+  directory = tempfile.mkdtemp()
+  try:
+    files = []
+    for i in range(5):
+      filename = os.path.join(directory, '%d.jpg' % i)
+      with open(filename, 'wb') as f:
+        f.write(b'%d' % i * 100)
+      files.append((filename, file_checksum(filename)))
+    state = os.path.join(directory, 'state.json')
+
+    assert verify(files, state, jobs=2) == ([], [], 0, [])
+    assert verify(files, state, jobs=2) == ([], [], 5, [])
+
+    with open(files[0][0], 'wb') as f:
+      f.write(b'corrupted')
+    os.unlink(files[1][0])
+    assert verify(files, state, jobs=2) == ([files[1][0]], [files[0][0]], 3, [])
+    assert verify(files, state, full=True) == ([files[1][0]], [files[0][0]], 0, [])
+
+    # files without checksum are not reported as corrupted
+    assert verify([(files[2][0], None)]) == ([], [], 0, [files[2][0]])
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_resume():
+
+  # tests that an interrupted iteration resumes where it stopped
+  import json
+
+  db = synthetic.database()
+  reference = [s.id for s in db.iter_objects(groups=('validation',), purposes=('real',), chunk_size=4)]
+
+  iterator = db.iter_objects(groups=('validation',), purposes=('real',), chunk_size=4)
+  first = [next(iterator).id for _ in range(10)]
+  cursor = json.loads(json.dumps(iterator.cursor()))
+  assert cursor['position'] == 10
+
+  rest = [s.id for s in db.resume(cursor, chunk_size=4)]
+  assert first + rest == reference
+
+  cursor = iterator.cursor(after=first[9])
+  assert [s.id for s in db.resume(cursor)] == reference[10:]
+
+
+def test_synthetic():
+
+  # tests the whole pipeline on a synthetic tree, without the real database
+  from nose.tools import assert_raises
+
+  db = synthetic.database()
+  assert len(db.objects(groups=('train',), purposes=('real',))) == 6
+  assert len(db.objects(groups=('train',), purposes=('attack',))) == 12
+  assert db.count_objects(groups=('validation',)) == 100
+  assert db.count_objects(groups=('test',)) == 20
+  assert db.subjects(groups=('train',)) == ['SYNT_AS0000', 'SYNT_AS0001']
+  assert db.count_objects(groups=('train',), complete=True) == 18
+
+  sample = db.objects(groups=('validation',))[0]
+  data = sample.load(synthetic.imagesdir, '.jpg', 'all')
+  assert data['color'].shape == (3, 32, 32)
+  assert data['infrared'].shape == (32, 32)
+
+  samples, stacked = next(db.load_batches([[s.id for s in db.objects(groups=('test',))[:4]]], stack=True))
+  assert stacked['depth'].shape == (4, 32, 32)
+
+  # created without checksums: nothing can be verified
+  assert_raises(ValueError, db.verify)
+
+
+def test_metrics():
+
+  # tests the counters, the latency histograms and the hooks of the metrics registry
+  from bob.db.casiasurf.metrics import Metrics
+
+  metrics = Metrics()
+  recorded = []
+  metrics.hooks.append(lambda kind, name, value: recorded.append((kind, name)))
+
+  metrics.incr('load.samples')
+  metrics.incr('load.bytes_read', 1000)
+  metrics.incr('load.bytes_read', 500)
+  for k in range(100):
+    metrics.observe('load.decode.color', 0.001 if k < 98 else 1.)
+  with metrics.timer('objects.query'):
+    pass
+
+  snapshot = metrics.snapshot(reset=True)
+  assert snapshot['counters'] == {'load.samples': 1, 'load.bytes_read': 1500}
+  decode = snapshot['latencies']['load.decode.color']
+  assert decode['count'] == 100
+  assert decode['max'] == 1.
+  assert 0.001 <= decode['p50'] < 0.002
+  assert decode['p99'] == 1.
+  assert snapshot['latencies']['objects.query']['count'] == 1
+  assert ('counter', 'load.samples') in recorded
+  assert ('latency', 'objects.query') in recorded
+  assert metrics.snapshot()['counters'] == {}
+
+  # the metrics of another process are added
+  other = Metrics()
+  other.merge(snapshot)
+  other.merge(snapshot)
+  merged = other.snapshot()
+  assert merged['counters'] == {'load.samples': 2, 'load.bytes_read': 3000}
+  assert merged['latencies']['load.decode.color']['count'] == 200
+  assert merged['latencies']['load.decode.color']['p99'] == 1.
+  assert merged['latencies']['load.decode.color']['min'] == decode['min']
+
+  metrics.enabled = False
+  metrics.incr('load.samples')
+  assert metrics.snapshot()['counters'] == {}
+
+
+def test_bench():
+
+  # tests the throughput report of the loading of the samples
+  from bob.db.casiasurf.bench import run
+
+  db = synthetic.database()
+  report = run(db, groups=('validation',), num_samples=10, workers=2)
+  assert report['samples'] == 10
+  assert report['workers'] == 2
+  assert report['bytes'] > 0
+  assert report['p50'] <= report['p99']
+  assert set(report['stages']) == set(['read', 'decode.color', 'decode.infrared', 'decode.depth'])
+
+  # the images are decoded from the pool of each worker
+  report = run(db, groups=('validation',), num_samples=10, workers=2, pool=True)
+  assert report['samples'] == 10
+  assert report['bytes'] > 0
+  assert report['pool'] is not None
+  assert set(report['stages']) == set(['decode.color', 'decode.infrared', 'decode.depth'])
+
+
+def test_parallel_create():
+
+  # the merged splits are the same as the serially built database
+  import tempfile, shutil
+  from bob.db.casiasurf.metrics import registry
+
+  directory = tempfile.mkdtemp()
+  try:
+    databases = {}
+    for serial in (True, False):
+      dbfile = os.path.join(directory, 'serial.sql3' if serial else 'parallel.sql3')
+      registry.reset()
+      synthetic.create(dbfile, serial=serial)
+      databases[serial] = synthetic.database(dbfile)
+      # the stages of the split processes are also recorded
+      assert 'create.files' in registry.snapshot()['latencies']
+
+    for protocol in ('all', 'color'):
+      for group in ('train', 'validation', 'test'):
+        for purpose in ('real', 'attack'):
+          serial = databases[True].objects(protocol=protocol, groups=group, purposes=purpose)
+          parallel = databases[False].objects(protocol=protocol, groups=group, purposes=purpose)
+          assert [s.id for s in serial] == [s.id for s in parallel]
+          for s, p in zip(serial, parallel):
+            assert sorted((f.path, f.modality, f.width, f.file_size) for f in s.files) == \
+                sorted((f.path, f.modality, f.width, f.file_size) for f in p.files)
+            assert s.modalities == p.modalities
+    ids = [f.id for f in databases[False].query(bob.db.casiasurf.models.ImageFile)]
+    assert len(set(ids)) == len(ids) == 3 * databases[False].count_objects()
+  finally:
+    shutil.rmtree(directory)
+
+
+def test_query_cache_rebuilt():
+
+  # tests that cached results are invalidated when the database is re-created
+  from bob.db.casiasurf import cache
+
+  with SyntheticTree(n_validation=10) as small, SyntheticTree(n_validation=15) as large:
+    cachedir = os.path.join(small.directory, 'cache')
+    try:
+      small.create(serial=True)
+      db = small.database(query_cache='disk', query_cache_directory=cachedir)
+      # purposes and groups are the first positional parameters
+      assert len(db.objects('real', 'validation')) == len(db.objects(groups='validation', purposes='real'))
+      assert len(db.objects(groups='validation')) == 10
+
+      large.create(small.dbfile, serial=True)
+      assert not os.path.exists(cachedir)
+      assert len(db.objects(groups='validation')) == 15
+    finally:
+      cache.clear()
+
+
+def test_thumbnails_stale():
+
+  # tests that thumbnail stores are removed or refused when the database is re-created
+  import shutil
+  from nose.tools import assert_raises
+  from bob.db.casiasurf import thumbnails
+
+  with SyntheticTree(n_subjects=1, n_frames=2, attack_types=(1,)) as tree:
+    store = thumbnails.default_directory(tree.dbfile)
+    tree.create(thumbnails_size=16)
+    db = tree.database()
+    sample = db.objects(groups='validation')[0]
+    assert sample.load(preprocessed=store)['depth'].shape == (16, 16)
+    # the database uses the store next to its own SQLite file
+    _, data = next(db.load_batches([[sample]], preprocessed=True, stack=True))
+    assert (data['depth'][0] == sample.load(preprocessed=store)['depth']).all()
+
+    # a store built for another database is refused
+    copy = os.path.join(tree.directory, 'copy')
+    shutil.copytree(store, copy)
+    tree.create()
+    assert not os.path.exists(store)
+    assert_raises(IOError, thumbnails.open_store, copy)
+
+
+def test_truncated_image():
+
+  # tests that a truncated image does not abort the creation, and has unknown dimensions
+  with SyntheticTree(n_subjects=1, n_frames=1, attack_types=(1,)) as tree:
+    with open(os.path.join(tree.imagesdir, 'Val/0000/000000-depth.jpg'), 'r+b') as f:
+      f.truncate(10)
+    tree.create()
+    files = dict((f.path, f) for f in tree.database().query(bob.db.casiasurf.models.ImageFile))
+    truncated = files['Val/0000/000000-depth']
+    assert (truncated.width, truncated.height, truncated.channels, truncated.file_size) == (None, None, None, 10)
+    assert files['Val/0000/000000-color'].width is not None
+
+
+def test_stack_16bit():
+
+  # tests that 16-bit images are stacked without being truncated
+  import numpy
+  import bob.io.base
+
+  with SyntheticTree(n_subjects=1, n_frames=1, attack_types=(1,), n_validation=3) as tree:
+    tree.create()
+    db = tree.database()
+    samples = db.objects(groups='validation')
+    # 16-bit depth maps, next to the JPEG images (which have the same dimensions)
+    depths = []
+    for s in samples:
+      depth = [f for f in s.files if f.modality == 'depth'][0]
+      depths.append(numpy.random.RandomState(0).randint(0, 65535, (32, 32)).astype(numpy.uint16))
+      bob.io.base.save(depths[-1], depth.make_path(tree.imagesdir, '.png'))
+
+    _, data = next(db.load_batches([samples], extension='.png', modality='depth', stack=True))
+    assert data['depth'].dtype != numpy.uint8
+    for k in range(len(samples)):
+      assert (data['depth'][k] == depths[k]).all()
+
+
+def test_group_by_shape():
+
+  # tests that samples with images of different dimensions are grouped before being stacked
+  import numpy
+  import bob.io.base
+  from nose.tools import assert_raises
+
+  with SyntheticTree(n_subjects=1, n_frames=1, attack_types=(1,), n_validation=6) as tree:
+    # the first 2 validation samples have larger images
+    for k in range(2):
+      for stream in ('color', 'ir', 'depth'):
+        shape = (3, 24, 40) if stream == 'color' else (24, 40)
+        bob.io.base.save(numpy.zeros(shape, dtype=numpy.uint8), os.path.join(tree.imagesdir, 'Val/0000/%06d-%s.jpg' % (k, stream)))
+    tree.create()
+    db = tree.database()
+
+    samples = db.objects(groups='validation')
+    assert_raises(ValueError, lambda: next(db.load_batches([samples], stack=True)))
+    groups = db.group_by_shape(samples, modality='depth')
+    assert [len(g) for g in groups] == [4, 2]
+    for group in groups:
+      _, stacked = next(db.load_batches([group], modality='depth', stack=True))
+      assert stacked['depth'].shape[0] == len(group)
+      assert stacked['depth'].dtype == numpy.uint8
@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# encoding: utf-8
+
+"""Precomputed face-crop thumbnails
+
+Thumbnails are the (annotated) faces, cropped and resized to a fixed size.
+Color thumbnails are stored as 3-channel images, and infrared and depth
+thumbnails as grayscale images.
+
+The store consists of one array per modality (``<modality>.npy``, of shape
+(N, 3, height, width) for color and (N, height, width) otherwise), along
+with the sorted ids of the corresponding :py:class:`ImageFile`
+(``<modality>.ids.npy``). Arrays are memory-mapped when read.
+
+Since thumbnails are indexed by the ids of the image files, which change
+when the database is re-created, the store is stamped with the size and
+modification time of the SQLite file it was built from (``stamp.json``),
+and stores that do not match their SQLite file any more are refused.
+"""
+
+import os
+import json
+import shutil
+
+import numpy
+
+from .models import ImageFile, Annotation, load_image, resize_image
+
+import bob.core
+logger = bob.core.log.setup('bob.db.casiasurf')
+
+# modalities stored as grayscale thumbnails
+GRAY_MODALITIES = ('infrared', 'depth')
+
+# opened stores, by directory
+_stores = {}
+
+
+def default_directory(dbfile=None):
+  """Returns the default directory of the store, next to the SQLite file"""
+  if dbfile is None:
+    from .driver import Interface
+    dbfile = Interface().files()[0]
+  return dbfile + '.thumbnails'
+
+
+def _stamp(dbfile):
+  """Returns the stamp of an SQLite file, see :py:func:`build`"""
+  stat = os.stat(dbfile)
+  return dict(dbfile=os.path.abspath(dbfile), size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+
+
+def remove(directory):
+  """Removes a store, if it exists, and forgets it if it was opened"""
+  _stores.pop(directory, None)
+  if os.path.exists(directory):
+    logger.info("Removing thumbnail store {}".format(directory))
+    shutil.rmtree(directory)
+
+
+def crop_and_resize(data, size, bbox=None):
+  """Crops the face in an image and resizes it
+
+  Parameters
+  ----------
+  data: :py:class:`numpy.ndarray`
+    The image, in Bob's format
+  size: tuple
+    The (height, width) of the thumbnail
+  bbox: tuple
+    The ``(topleft, bottomright)`` corners of the face, as (y, x). If
+    ``None``, the whole image is used (CASIA-SURF images are already
+    cropped around the face).
+
+  Returns
+  -------
+  :py:class:`numpy.ndarray`:
+    The thumbnail
+  """
+  if bbox is not None:
+    (top, left), (bottom, right) = bbox
+    top, left = max(int(top), 0), max(int(left), 0)
+    data = data[..., top:int(bottom), left:int(right)]
+
+  return resize_image(data, size)
+
+
+def _make_thumbnail(task):
+  """Computes a single thumbnail (run in a worker process)"""
+  filename, bbox, modality, size = task
+  data = load_image(filename, gray=modality in GRAY_MODALITIES)
+  return crop_and_resize(data, size, bbox)
+
+
+def build(session, imagesdir, directory, dbfile, size=(112, 112), extension='.jpg', jobs=1):
+  """Builds the thumbnails of all the image files in the database
+
+  Parameters
+  ----------
+  session:
+    The session to the SQLite database
+  imagesdir: str
+    The directory where to find the images
+  directory: str
+    The directory of the store (it is replaced if it exists)
+  dbfile: str
+    The SQLite file of the session, the store is stamped with. It must not
+    be modified afterwards.
+  size: tuple
+    The (height, width) of the thumbnails. Faces are cropped with the
+    :py:class:`Annotation` stored in the database; the whole image is used
+    for files that are not annotated.
+  extension: str
+    The extension of the image files
+  jobs: int
+    The number of parallel processes
+  """
+  import multiprocessing
+  from numpy.lib.format import open_memmap
+
+  remove(directory)
+  os.makedirs(directory)
+
+  pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+  try:
+    for modality in ImageFile.modality_choices:
+      files = session.query(ImageFile.id, ImageFile.path, Annotation)\
+                     .outerjoin((Annotation, Annotation.file_id == ImageFile.id))\
+                     .filter(ImageFile.modality == modality)\
+                     .order_by(ImageFile.id).all()
+      logger.info("Building {} {} thumbnails...".format(len(files), modality))
+
+      shape = (size[0], size[1]) if modality in GRAY_MODALITIES else (3, size[0], size[1])
+      data = open_memmap(os.path.join(directory, modality + '.npy'), mode='w+',
+          dtype=numpy.uint8, shape=(len(files),) + shape)
+
+      tasks = [(
+        os.path.join(imagesdir, path + extension),
+        (a.topleft, a.bottomright) if a is not None else None,
+        modality,
+        size) for _, path, a in files]
+      thumbnails = pool.imap(_make_thumbnail, tasks, chunksize=64) if pool else map(_make_thumbnail, tasks)
+      for i, thumbnail in enumerate(thumbnails):
+        data[i] = thumbnail
+
+      data.flush()
+      del data
+      numpy.save(os.path.join(directory, modality + '.ids.npy'), numpy.array([i for i, _, _ in files], dtype=numpy.int64))
+  finally:
+    if pool is not None:
+      pool.close()
+      pool.join()
+
+  with open(os.path.join(directory, 'stamp.json'), 'w') as f:
+    json.dump(_stamp(dbfile), f)
+
+
+class ThumbnailStore(object):
+  """Reads thumbnails from a store built by :py:func:`build`
+
+  Parameters
+  ----------
+  directory: str
+    The directory of the store
+  """
+
+  def __init__(self, directory):
+    if not os.path.isdir(directory):
+      raise IOError("There is no thumbnail store at '%s'; did you run 'bob_dbmanage.py casiasurf create' with --thumbnails-size ?" % directory)
+    self.directory = directory
+    try:
+      with open(os.path.join(directory, 'stamp.json')) as f:
+        self.stamp = json.load(f)
+    except (IOError, OSError, ValueError):
+      self.stamp = None
+    if self.stale():
+      raise IOError("The thumbnail store at '%s' does not match its database (any more); re-run 'bob_dbmanage.py casiasurf create' with --thumbnails-size" % directory)
+    self._arrays = {}
+
+  def stale(self):
+    """Returns whether the SQLite file changed since the store was built"""
+    if self.stamp is None:
+      return True
+    try:
+      return _stamp(self.stamp['dbfile']) != self.stamp
+    except OSError:
+      return True
+
+  def _open(self, modality):
+    if modality not in self._arrays:
+      ids = numpy.load(os.path.join(self.directory, modality + '.ids.npy'))
+      data = numpy.load(os.path.join(self.directory, modality + '.npy'), mmap_mode='r')
+      self._arrays[modality] = (ids, data)
+    return self._arrays[modality]
+
+  def shape(self, modality):
+    """Returns the shape of the thumbnails of a modality"""
+    return self._open(modality)[1].shape[1:]
+
+  def get(self, file_id, modality):
+    """Returns the thumbnail of an image file
+
+    Parameters
+    ----------
+    file_id: int
+      The id of the :py:class:`ImageFile`
+    modality: str
+      The modality of the file
+
+    Returns
+    -------
+    :py:class:`numpy.ndarray`:
+      The thumbnail
+    """
+    ids, data = self._open(modality)
+    index = numpy.searchsorted(ids, file_id)
+    if index == len(ids) or ids[index] != file_id:
+      raise KeyError("There is no thumbnail for file %d in '%s'" % (file_id, self.directory))
+    return numpy.array(data[index])
+
+
+def open_store(directory=None):
+  """Returns the (shared) store in the given directory, by default next to the SQLite file
+
+  Opened stores are shared, and are checked against their SQLite file each
+  time they are returned.
+  """
+  if directory is None:
+    directory = default_directory()
+  if directory in _stores and _stores[directory].stale():
+    del _stores[directory]
+  if directory not in _stores:
+    _stores[directory] = ThumbnailStore(directory)
+  return _stores[directory]